@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import struct
+import hashlib
+from array import array
+
+# One splat .asciz/.txt.s file, read in a single pass:
+#   addresses  array('I') of the original string addresses, in file order
+#   strings    the .asciz texts, escapes already decoded
+#   pointers   array('I') of the .word pointer table, in file order
+#   raw        the original text bytes from the hex comments (.txt.s only)
+class AscizFile:
+    __slots__ = ('path', 'addresses', 'strings', 'pointers', 'raw')
+
+    def __init__(self, path, addresses, strings, pointers, raw):
+        self.path = path
+        self.addresses = addresses
+        self.strings = strings
+        self.pointers = pointers
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.addresses)
+
+    @property
+    def base(self):
+        return self.addresses[0]
+
+    def pointer_blob(self):
+        return le_words(self.pointers)
+
+    def text_blob(self):
+        # The strings as the compiler laid them out: NUL terminated, each one
+        # aligned to 4 bytes
+        blob = bytearray()
+        base = self.base
+        for s in self.strings:
+            blob += s.encode('utf-8') + b'\x00'
+            blob += b'\x00' * (-(base + len(blob)) & 3)
+        return bytes(blob)
+
+def le_words(words):
+    if sys.byteorder == 'big':
+        words = array('I', words)
+        words.byteswap()
+    return words.tobytes()
+
+_hex_digits = frozenset("0123456789ABCDEFabcdef")
+
+def parse_asciz(path, source=None):
+    if source is None:
+        with open(path, 'rb') as f:
+            source = f.read()
+
+    addresses = array('I')
+    strings = []
+    pointers = array('I')
+    raw = bytearray()
+    for line in source.decode('utf-8').split('\n'):
+        if '.asciz' in line:
+            try:
+                comment, rest = line.split('*/')
+                addr = int(comment.split()[-1], 16)
+                q1 = rest.index('"') + 1
+                q2 = rest.rindex('"')
+                text = bytes(rest[q1:q2], 'utf-8').decode('unicode_escape')
+            except:
+                continue
+            addresses.append(addr)
+            strings.append(text)
+        elif '.word' in line:
+            pointers.append(int(line.split('.word')[1].strip(), 16))
+        else:
+            line = line.strip()
+            if line.startswith("/*") and line.endswith("*/"):
+                content = line[2:-2].strip()
+                if content and _hex_digits.issuperset(content):
+                    raw += bytes.fromhex(content)
+
+    return AscizFile(path, addresses, strings, pointers, bytes(raw))
+
+# Binary index kept next to the source as <file>.idx. It is trusted when the
+# source size and mtime match; if only the mtime changed the source hash
+# decides, so a touch or a fresh checkout doesn't force a reparse.
+_index_magic = b'SHAZ'
+_index_version = 1
+_index_header = struct.Struct('<4sIQQ20sIII')
+
+def _write_index(asciz, st, digest):
+    lengths = array('I')
+    text = bytearray()
+    for s in asciz.strings:
+        encoded = s.encode('utf-8')
+        lengths.append(len(encoded))
+        text += encoded
+
+    header = _index_header.pack(_index_magic, _index_version, st.st_size, st.st_mtime_ns,
+                                digest, len(asciz.addresses), len(asciz.pointers), len(asciz.raw))
+    tmp = asciz.path + ".idx.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(le_words(asciz.addresses))
+        f.write(le_words(lengths))
+        f.write(le_words(asciz.pointers))
+        f.write(asciz.raw)
+        f.write(text)
+    os.replace(tmp, asciz.path + ".idx")
+
+def _read_words(data, offset, count):
+    words = array('I')
+    words.frombytes(data[offset: offset + 4 * count])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words, offset + 4 * count
+
+def _read_index(path, data):
+    _, _, _, _, _, entries, npointers, nraw = _index_header.unpack_from(data)
+    offset = _index_header.size
+    addresses, offset = _read_words(data, offset, entries)
+    lengths, offset = _read_words(data, offset, entries)
+    pointers, offset = _read_words(data, offset, npointers)
+    raw = data[offset: offset + nraw]
+    offset += nraw
+
+    strings = []
+    for length in lengths:
+        strings.append(data[offset: offset + length].decode('utf-8'))
+        offset += length
+
+    return AscizFile(path, addresses, strings, pointers, raw)
+
+def load_asciz(path):
+    st = os.stat(path)
+    try:
+        with open(path + ".idx", 'rb') as f:
+            data = f.read()
+        magic, version, size, mtime, indexed, *_ = _index_header.unpack_from(data)
+    except (OSError, struct.error):
+        magic = None
+
+    fresh = magic == _index_magic and version == _index_version and size == st.st_size
+    if fresh and mtime == st.st_mtime_ns:
+        return _read_index(path, data)
+
+    with open(path, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha1(source).digest()
+    if fresh and digest == indexed:
+        asciz = _read_index(path, data)
+    else:
+        asciz = parse_asciz(path, source)
+    _save_index(asciz, st, digest)
+    return asciz
+
+def _save_index(asciz, st, digest):
+    # The index is only a speed-up, a read-only checkout still works without it
+    try:
+        _write_index(asciz, st, digest)
+    except OSError:
+        pass
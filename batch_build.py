@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import argparse
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+from common import *
+from patchfile import *
+import translate_silent
+
+# Builds every translation set against every base image. The .asciz sources
+# are parsed and the overlays located once per image in this process; the
+# workers get both through the pool initializer, once per worker rather than
+# once per target, and each builds one target: a copy-on-write DiscImage of
+# the base image, patched with the set's text and character table, written
+# as a clone of the base image or as patches.
+#
+# A translation set is a directory with the *.asciz.tr.txt files and an
+# optional charset.json mapping its letters to the glyphs the font draws them
+# with, like codec.LocalCharacters (which is used when there is none).
+TranslationSet = namedtuple("TranslationSet", ["name", "path", "characters"])
+Target = namedtuple("Target", ["image", "member", "tr_set", "outputs", "log"])
+
+def load_translation_set(path):
+    path = os.path.abspath(path)
+    charset = os.path.join(path, "charset.json")
+    characters = load_local_characters(charset) if os.path.exists(charset) else dict(LocalCharacters)
+    return TranslationSet(os.path.basename(path), path, characters)
+
+_sources = None
+_located = None
+_spill = False
+
+def _init_worker(sources, located, spill):
+    global _sources, _located, _spill
+    _sources = sources
+    _located = located
+    _spill = spill
+
+def build_target(target):
+    set_local_characters(target.tr_set.characters)
+    located = _located[target.image]
+    errors = 0
+    # the image is closed with the target, or the pool's reused workers would
+    # keep every image they built for mark_dirty to look through
+    with open_image(target.image, target.member) as image, open(target.log, 'w') as log, \
+         contextlib.redirect_stdout(log):
+        for ov, asciz in _sources.items():
+            tr_path = os.path.join(target.tr_set.path, ov + ".tr.txt")
+            try:
+                translate_silent.patch_overlay(image.data, ov, located.get(ov), asciz, tr_path,
+                                               dump=False, spill=_spill)
+            except Exception as e:
+                print(f"error with {ov}, {e}")
+                traceback.print_exc(file=log)
+                errors += 1
+
+        for path in target.outputs:
+            if os.path.splitext(path)[1].lower() in PatchFormats:
+                write_patch(image, path)
+            else:
+                image.save(path)
+    return errors
+
+def plan_targets(images, member, tr_sets, out_dir, formats):
+    targets = []
+    for image in images:
+        stem, ext = os.path.splitext(os.path.basename(image))
+        for tr_set in tr_sets:
+            name = os.path.join(out_dir, f"{stem}.{tr_set.name}")
+            outputs = [name + (ext if fmt == "image" else "." + fmt) for fmt in formats]
+            targets.append(Target(image, member, tr_set, outputs, name + ".log"))
+    return targets
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build every translation set against every base image")
+    parser.add_argument("--image", action="append", required=True,
+                        help="a base image (SILENT or the disc); can be given more than once")
+    parser.add_argument("--set", action="append", required=True, metavar="DIR",
+                        help="a directory with *.asciz.tr.txt files and an optional charset.json; "
+                             "can be given more than once")
+    parser.add_argument("--out", default="builds", metavar="DIR", help="where the targets go")
+    parser.add_argument("--format", action="append", choices=["image", "ppf", "ips"],
+                        help="write each target as a patched image (a clone of the base image), "
+                             "a patch or several of these (default: image)")
+    parser.add_argument("--file", metavar="NAME",
+                        help="patch this file of the CD images (e.g. SILENT) sector by sector")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="build this many targets at once (0 = one per core)")
+    parser.add_argument("--spill", action="store_true",
+                        help="move text that doesn't fit its block into the zeros at the end of the "
+                             "overlay instead of failing, as translate_silent.py --spill")
+    args = parser.parse_args(argv)
+
+    tr_sets = [load_translation_set(path) for path in args.set]
+    os.makedirs(args.out, exist_ok=True)
+
+    sources = {}
+    for ov in translate_silent.Overlays:
+        try:
+            sources[ov] = load_asciz(ov)
+        except Exception as e:
+            print(f"error with {ov}, {e}")
+
+    located = {}
+    for path in args.image:
+        with open_image(path, args.file) as image:
+            sidecar = os.path.join(args.out, os.path.basename(path) + ".located.json")
+            located[path] = translate_silent.locate_overlays(image.data, path, list(sources), sidecar, args.file)
+
+    if args.spill:
+        print("warning: --spill moves the text that doesn't fit into the zeros at the end of its "
+              "overlay, which may be the overlay's own data; the logs name the overlays")
+    targets = plan_targets(args.image, args.file, tr_sets, args.out, args.format or ["image"])
+    with ProcessPoolExecutor(args.jobs or None, initializer=_init_worker, initargs=(sources, located, args.spill)) as pool:
+        futures = [pool.submit(build_target, target) for target in targets]
+        for target, future in zip(targets, futures):
+            try:
+                errors = future.result()
+                status = f"{errors} overlays failed, see {target.log}" if errors else "ok"
+            except Exception as e:
+                status = f"error, {e}"
+            print(f"{', '.join(target.outputs)}: {status}")
+
+if __name__ == "__main__":
+    main()
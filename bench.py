@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import re
+import glob
+import time
+import random
+import struct
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from common import *
+import maps
+import bodyprog
+import translate_silent
+import layout
+import textures
+
+def best_of(fn, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def report(results, name, seconds, baseline=None):
+    line = f"{name:<40} {seconds * 1000:10.3f} ms"
+    if baseline:
+        line += f"  ({baseline / seconds:.1f}x)"
+    print(line)
+    results.append(line)
+
+# The encoders as they were before codec.py, to compare against
+def old_read_asciz(text_file):
+    entries = {}
+    with open(text_file, encoding='utf-8') as f:
+        for line in f:
+            if '.asciz' not in line:
+                continue
+            comment, rest = line.split('*/')
+            addr = int(comment.split()[-1], 16)
+            entries[addr] = {'asciz': rest[rest.index('"') + 1: rest.rindex('"')], 'new-ptr': 0}
+
+    pointers = []
+    with open(text_file, encoding='utf-8') as f:
+        for line in f:
+            if '.word' in line:
+                pointers.append(int(line.split('.word')[1].strip(), 16))
+    return entries, pointers
+
+def old_read_c_string(data, offset):
+    end = offset
+    while end < len(data) and data[end] != 0:
+        end += 1
+    return data[offset:end].tobytes().decode('ascii')
+
+def old_read_table(mapdata, ptroffset, endoffset):
+    msgs = []
+    msgptr = ptroffset
+    while msgptr != endoffset:
+        msg = read_uint32_le(mapdata, msgptr)
+        if msg == 0:
+            break
+        msgs.append(old_read_c_string(mapdata, msg - maps._offset))
+        msgptr += 4
+    return msgs
+
+def old_fix_encoding(txt):
+    txt = txt.replace('ł', ';').replace('ó', '*').replace('ę', '>').replace('ą', '^')
+    txt = txt.replace('ż', '=').replace('ć', '<').replace('ń', '+').replace('ś', '/').replace('ź', 'Q')
+    return txt.replace(' ', '@@@').replace('_', ' ').replace('@@@', '_').replace('\n', ' ~N ')
+
+def old_decode(msg):
+    msg = msg.replace('_', '@@@').replace(' ', '').replace('@@@', ' ')
+    msg = msg.replace(')\t', ')\\t').replace('\t', '').replace(')\\t', ')\t')
+    msg = msg.replace('\n', '').replace('~N', '\n')
+    msg =  re.sub(r'\s*~C\d\s*', lambda m: f' {m.group(0).strip()} ', msg)
+    msg =  re.sub(r'\s*~S\d\s*', lambda m: f' {m.group(0).strip()} ', msg)
+    msg =  re.sub(r'\s*~L\d\s*', lambda m: f' {m.group(0).strip()} ', msg)
+    msg =  re.sub(r'\s*~D\s*', lambda m: f' {m.group(0).strip()} ', msg)
+    msg =  re.sub(r'\s*~H\s*', lambda m: f' {m.group(0).strip()} ', msg)
+    msg =  re.sub(r'\s*~E\s*', lambda m: f' {m.group(0).strip()} ', msg)
+    msg =  re.sub(r'\s*~M\s*', lambda m: f' {m.group(0).strip()} ', msg)
+    msg =  re.sub(r'^ ~', '~', msg)
+    return msg
+
+def old_nice_encode(line):
+    pattern = re.compile(r'(~[CLS]\d|~[MDHETN])')
+    jpattern= re.compile(r'(~J\d\(\d+\.\d+\))')
+    line = line.replace(' ', '').replace('\n', '').replace('\t', '')
+    line = line.replace('_', ' ')
+    line = pattern.sub(r'{\1}', line)
+    return jpattern.sub(r'{\1}', line).strip()
+
+def load_messages():
+    msgs = []
+    for filename in sorted(glob.glob("*.asciz")):
+        with open(filename, encoding='utf-8') as f:
+            for line in f:
+                if '.asciz' not in line:
+                    continue
+                rest = line.split('*/')[1]
+                text = rest[rest.index('"') + 1: rest.rindex('"')]
+                msgs.append(bytes(text, 'utf-8').decode('unicode_escape'))
+
+    lines = []
+    for filename in sorted(glob.glob("*.tr.txt")):
+        with open(filename, encoding='utf-8') as f:
+            lines += [entry.strip() for entry in f.read().split('\n-------')]
+
+    return msgs, lines
+
+def bench_codec(results):
+    msgs, lines = load_messages()
+
+    def cold(fn, items):
+        def run():
+            fn.cache_clear()
+            for item in items:
+                fn(item)
+        return run
+
+    old = best_of(lambda: [old_fix_encoding(line).encode('ascii') for line in lines])
+    report(results, "codec: encode .tr.txt (old chain)", old)
+    report(results, "codec: encode .tr.txt", best_of(cold(encode_plain, lines)), old)
+    report(results, "codec: encode .tr.txt (memoized)", best_of(lambda: encode_overlay(lines)), old)
+
+    old = best_of(lambda: [old_decode(msg) for msg in msgs])
+    report(results, "codec: decode dump (old regex passes)", old)
+    report(results, "codec: decode dump", best_of(cold(decode_plain, msgs)), old)
+
+    old = best_of(lambda: [old_nice_encode(msg) for msg in msgs])
+    report(results, "codec: decode braced (old chain)", old)
+    report(results, "codec: decode braced", best_of(cold(decode_braced, msgs)), old)
+
+def bench_asciz(results):
+    files = sorted(glob.glob("map*.asciz")) + sorted(glob.glob("*.txt.s"))
+    for filename in files:
+        load_asciz(filename)
+
+    old = best_of(lambda: [old_read_asciz(filename) for filename in files])
+    report(results, "asciz: read_asciz + read_pointers (old)", old)
+    report(results, "asciz: parse", best_of(lambda: [parse_asciz(filename) for filename in files]), old)
+    report(results, "asciz: load from .idx", best_of(lambda: [load_asciz(filename) for filename in files]), old)
+
+def bench_sectors(results):
+    sector = bytearray(SECTOR_SIZE)
+    sector[:12] = b'\x00' + b'\xff' * 10 + b'\x00'
+    sector[15] = 2
+    sector[USER_OFFSET: USER_OFFSET + USER_SIZE] = bytes(range(256)) * 8
+    count = 2000
+
+    def one_at_a_time():
+        for _ in range(count):
+            regenerate_sectors(bytearray(sector))
+
+    old = best_of(one_at_a_time, repeat=1)
+    report(results, f"sectors: EDC/ECC, {count} sectors one by one", old)
+    report(results, f"sectors: EDC/ECC, {count} sectors at once",
+           best_of(lambda: regenerate_sectors(sector * count), repeat=3), old)
+
+def bench_layout(results):
+    overlays = sorted(glob.glob("map*.asciz"))
+    table = bytes(random.Random(1).randrange(4, 12) for _ in range(layout.FontGlyphs))
+
+    def check(metrics):
+        return lambda: layout.check_overlays(metrics, overlays)
+
+    cold = best_of(lambda: check(layout.FontMetrics(table))(), repeat=3)
+    report(results, "layout: check all overlays", cold)
+    report(results, "layout: check all overlays (memoized)", best_of(check(layout.FontMetrics(table))), cold)
+
+    metrics = layout.FontMetrics(table)
+    entries = [entry for ov in overlays for entry in layout.read_tr_lines(ov + ".tr.txt")]
+    report(results, "layout: reflow every entry", best_of(lambda: [layout.reflow(metrics, e, 300) for e in entries], repeat=3))
+
+def make_tims(count=64, seed=1):
+    # 256x256 sheets, a third each of 4, 8 and 16 bpp, between random bytes
+    rnd = random.Random(seed)
+    data = bytearray()
+    for i in range(count):
+        bpp = (4, 8, 16)[i % 3]
+        flags = {4: 8, 8: 9, 16: 2}[bpp]
+        data += rnd.randbytes(100) + struct.pack('<II', 0x10, flags)
+        if bpp < 16:
+            colors = 16 if bpp == 4 else 256
+            data += struct.pack('<IHHHH', 12 + 2 * colors, 0, 480, colors, 1)
+            data += b''.join(struct.pack('<H', 0x8000 | c) for c in rnd.sample(range(0x8000), colors))
+        w = 256 * bpp // 16
+        data += struct.pack('<IHHHH', 12 + 2 * w * 256, 0, 0, w, 256) + rnd.randbytes(2 * w * 256)
+    return memoryview(data)
+
+def bench_textures(results):
+    data = make_tims()
+    tims = textures.find_tims(data)
+    report(results, f"textures: find {len(tims)} TIMs in {len(data) >> 20} MiB", best_of(lambda: textures.find_tims(data)))
+    rgba = {}
+
+    def decode():
+        for tim in tims:
+            rgba[tim] = textures.tim_rgba(data, tim)
+
+    def encode():
+        for tim in tims:
+            textures.rgba_to_tim(data, tim, rgba[tim])
+
+    report(results, f"textures: decode {len(tims)} 256x256 TIMs to RGBA", best_of(decode, repeat=3))
+    report(results, f"textures: encode {len(tims)} 256x256 TIMs from RGBA", best_of(encode, repeat=3))
+
+# Synthetic game data. The disc can't be committed, so the image benchmarks
+# build a SILENT with the real overlay layout: random filler, the real text
+# blocks of every map at their original offsets with a pointer table after
+# them, and a BODYPROG with an inventory, encrypted like the original.
+Silent = namedtuple("Silent", ["path", "size", "strings"])
+ImageSizes = [0]
+_workspace = None
+_silents = {}
+
+def _map_strings(ovi):
+    try:
+        asciz = load_asciz(os.path.join(_repo, ovi.filename + ".asciz"))
+        return asciz.base - maps._offset, asciz.text_blob(), asciz.pointers
+    except OSError:
+        pass
+
+    strings = [f"\tLine_{i}_of_{ovi.filename}. ~N\n\tSecond_line. ~E ".encode() + b'\x00' for i in range(40)]
+    text, offsets, _ = pack_strings(strings)
+    return 0x1000, text, array('I', [maps._offset + 0x1000 + offset for offset in reversed(offsets)])
+
+def _fake_bodyprog(silent):
+    program = extract_overlay(silent, BodyProg)
+    text = 0x1b1c
+    names = 0x800ADB60 - bodyprog._offset
+    descs = 0x800ADE6C - bodyprog._offset
+    for i in range(200):
+        for table, line in ((names, f"Item_{i}"), (descs, f"Item_{i}_is_here. ~N ")):
+            patch_pointer(program, bodyprog._offset + text, table + 4 * i)
+            patch_blob(program, line.encode() + b'\x00', text)
+            text += len(line) + 1
+    xorBodyprog(silent)
+
+def make_silent(size=0, seed=1):
+    last = maps.OverlayInfos[-1]
+    size = max(size, (last.sector_start - 0x40) * 0x800 + last.block_size * 0x100)
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        data += rng.randbytes(min(size - len(data), 1 << 24))
+    silent = memoryview(data)
+    _fake_bodyprog(silent)
+
+    strings = 0
+    for ovi in maps.OverlayInfos:
+        mapdata = extract_overlay(silent, ovi)
+        txt_offset, text, pointers = _map_strings(ovi)
+        ptr_offset = (txt_offset + len(text) + 3) & ~3
+        patch_blob(mapdata, text, txt_offset)
+        patch_blob(mapdata, le_words(pointers) + bytes(4), ptr_offset)
+        patch_pointer(mapdata, maps._offset + ptr_offset, 0x34)
+        patch_pointer(mapdata, maps._offset + ptr_offset + 4 * len(pointers), 0x28)
+        strings += len(pointers)
+    return data, strings
+
+def make_disc(silent, first=0x40):
+    # A raw Mode 2 image holding SILENT, with a minimal ISO9660 directory
+    def record(lba, size, name, flags):
+        entry = bytearray(33 + len(name) + (1 - len(name) % 2))
+        entry[0] = len(entry)
+        struct.pack_into('<I4xI', entry, 2, lba, size)
+        entry[25] = flags
+        entry[32] = len(name)
+        entry[33: 33 + len(name)] = name
+        return bytes(entry)
+
+    def bcd(n):
+        return (n // 10) * 16 + n % 10
+
+    sectors = (len(silent) + USER_SIZE - 1) // USER_SIZE
+    pvd = bytearray(USER_SIZE)
+    pvd[:6] = b'\x01CD001'
+    pvd[156: 156 + 34] = record(18, USER_SIZE, b'\x00', 2)
+    root = record(18, USER_SIZE, b'\x00', 2) + record(first, len(silent), b'SILENT;1', 0)
+    user = {16: bytes(pvd), 17: b'\xffCD001', 18: root}
+
+    disc = bytearray((first + sectors) * SECTOR_SIZE)
+    for lba in range(first + sectors):
+        start = lba * SECTOR_SIZE
+        minute, frame = divmod(lba + 150, 75)
+        minute, second = divmod(minute, 60)
+        disc[start: start + 12] = b'\x00' + b'\xff' * 10 + b'\x00'
+        disc[start + 12: start + 24] = bytes([bcd(minute), bcd(second), bcd(frame), 2]) + b'\x00\x00\x08\x00' * 2
+        if lba >= first:
+            payload = silent[(lba - first) * USER_SIZE: (lba - first + 1) * USER_SIZE]
+        else:
+            payload = user.get(lba, b'')
+        disc[start + USER_OFFSET: start + USER_OFFSET + len(payload)] = payload
+    regenerate_sectors(disc)
+    return disc
+
+_repo = os.path.dirname(os.path.abspath(__file__))
+
+@contextlib.contextmanager
+def workspace():
+    # A temp dir with the text sources, where the tools can write their
+    # messages/, info.*, translate.*, located.json and .buildcache
+    global _workspace
+    if _workspace is None:
+        _workspace = tempfile.TemporaryDirectory(prefix="bench-")
+        os.mkdir(os.path.join(_workspace.name, "messages"))
+        for path in glob.glob(os.path.join(_repo, "*.asciz")) + glob.glob(os.path.join(_repo, "*.tr.txt")):
+            name = os.path.basename(path)
+            if not name.startswith(("info.", "translate.")):
+                os.symlink(path, os.path.join(_workspace.name, name))
+
+    cwd = os.getcwd()
+    os.chdir(_workspace.name)
+    try:
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet), contextlib.redirect_stderr(quiet):
+            yield _workspace.name
+    finally:
+        os.chdir(cwd)
+
+def synthetic_silent(size=0, disc=False):
+    key = (size, disc)
+    if key not in _silents:
+        data, strings = make_silent(size * 1024 * 1024)
+        if disc:
+            data = make_disc(data)
+        path = os.path.join(_workspace.name, f"silent-{size}{'.bin' if disc else ''}")
+        with open(path, 'wb') as f:
+            f.write(data)
+        _silents[key] = Silent(path, len(data), strings)
+    return _silents[key]
+
+def bench_image(results):
+    with workspace():
+        silent = synthetic_silent()
+        image = DiscImage(silent.path)
+        xor = best_of(lambda: xorBodyprog(image.view))
+
+        offsets = []
+        for ovi in maps.OverlayInfos:
+            mapdata = extract_overlay(image.view, ovi)
+            table = read_uint32_le(mapdata, 0x34) - maps._offset
+            end = read_uint32_le(mapdata, 0x28) - maps._offset
+            for ptr in range(table, end, 4):
+                offsets.append((mapdata, read_uint32_le(mapdata, ptr) - maps._offset))
+        strings = best_of(lambda: [read_c_string(mapdata, offset) for mapdata, offset in offsets])
+
+        dump = best_of(lambda: [maps.dump_map_messages(image.view, ovi) for ovi in maps.OverlayInfos])
+        patch = best_of(lambda: [maps.patch_map(image.view, ovi) for ovi in maps.OverlayInfos])
+
+    report(results, "image: xorBodyprog", xor)
+    report(results, f"image: read_c_string x{len(offsets)}", strings)
+    report(results, f"image: dump_map_messages x{len(maps.OverlayInfos)}", dump)
+    report(results, f"image: patch_map x{len(maps.OverlayInfos)}", patch)
+
+def bench_overlays(results):
+    with workspace():
+        silent = synthetic_silent()
+        image = DiscImage(silent.path)
+        overlays = [ovi.filename + ".asciz" for ovi in maps.OverlayInfos if os.path.exists(ovi.filename + ".asciz")]
+        located = translate_silent.locate_overlays(image.data, silent.path, overlays)
+
+        def patch_all():
+            for ov in overlays:
+                translate_silent.patch_overlay(image.data, ov, located[ov])
+        seconds = best_of(patch_all)
+
+    report(results, f"overlays: patch_overlay x{len(overlays)}", seconds)
+
+def bench_strings(results):
+    with workspace():
+        silent = DiscImage(synthetic_silent().path).view
+        tables = []
+        for ovi in maps.OverlayInfos:
+            mapdata = extract_overlay(silent, ovi)
+            tables.append((mapdata, read_uint32_le(mapdata, 0x34) - maps._offset,
+                           read_uint32_le(mapdata, 0x28) - maps._offset))
+
+        old = best_of(lambda: [old_read_table(*table) for table in tables])
+        bulk = best_of(lambda: [read_string_table(m, p, e, base=maps._offset) for m, p, e in tables])
+        decoded = best_of(lambda: [read_string_table(m, p, e, base=maps._offset).decode() for m, p, e in tables])
+
+    report(results, f"strings: read {len(tables)} tables (old byte loop)", old)
+    report(results, f"strings: read {len(tables)} tables", bulk, old)
+    report(results, f"strings: read and decode {len(tables)} tables", decoded, old)
+
+def _run_main(*args):
+    translate_silent.main(list(args))
+
+def bench_main(results):
+    for size in ImageSizes:
+        with workspace():
+            silent = synthetic_silent(size)
+            out = silent.path + ".out"
+            label = f"{silent.size / (1024 * 1024):.0f} MiB"
+
+            def cold():
+                for leftover in ("located.json", out):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                _run_main(silent.path, out, "--no-cache")
+
+            first = best_of(cold, repeat=1)
+            located = best_of(lambda: _run_main(silent.path, out, "--no-cache"), repeat=3)
+            traced = best_of(lambda: _run_main(silent.path, out, "--no-cache", "--trace", "trace.json"), repeat=3)
+            _run_main(silent.path, out)
+            cached = best_of(lambda: _run_main(silent.path, out), repeat=3)
+
+        report(results, f"main: {label}, cold", first)
+        report(results, f"main: {label}, located.json", located, first)
+        report(results, f"main: {label}, located.json, --trace", traced, first)
+        report(results, f"main: {label}, build cache", cached, first)
+
+    with workspace():
+        disc = synthetic_silent(disc=True)
+        out = disc.path + ".out"
+        seconds = best_of(lambda: _run_main(disc.path, out, "--no-cache", "--file", "SILENT"), repeat=3)
+    report(results, f"main: raw disc {disc.size / (1024 * 1024):.0f} MiB, --file SILENT", seconds)
+
+def bench_startup(results):
+    # A fresh interpreter per command, as scripts that call the tools pay it
+    def command(*args):
+        return lambda: subprocess.run([sys.executable, *args], cwd=_repo, check=False,
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    bare = best_of(command("-c", "pass"))
+    report(results, "startup: python", bare)
+    report(results, "startup: cli.py (usage)", best_of(command("cli.py")))
+    report(results, "startup: cli.py report --help", best_of(command("cli.py", "report", "--help")))
+    report(results, "startup: cli.py patch --help", best_of(command("cli.py", "patch", "--help")))
+    report(results, "startup: translate_silent.py --help", best_of(command("translate_silent.py", "--help")))
+
+    with workspace():
+        with open("script.txt", 'w') as f:
+            f.write("report --help\n" * 10)
+        separate = best_of(lambda: [command("cli.py", "report", "--help")() for _ in range(10)], repeat=3)
+        together = best_of(command("cli.py", "script", os.path.abspath("script.txt")), repeat=3)
+    report(results, "startup: 10 commands, 10 processes", separate)
+    report(results, "startup: 10 commands, cli.py script", together, separate)
+
+Benchmarks = {
+    "codec": bench_codec,
+    "asciz": bench_asciz,
+    "sectors": bench_sectors,
+    "strings": bench_strings,
+    "layout": bench_layout,
+    "textures": bench_textures,
+    "image": bench_image,
+    "overlays": bench_overlays,
+    "main": bench_main,
+    "startup": bench_startup,
+}
+
+def main(argv=None):
+    global ImageSizes
+    parser = argparse.ArgumentParser(description="Benchmark the build on synthetic data")
+    parser.add_argument("names", nargs="*", metavar="name",
+                        help=f"benchmarks to run: {', '.join(Benchmarks)} (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=ImageSizes, metavar="MIB",
+                        help="SILENT sizes for the main benchmark, 0 is the real layout; "
+                             "pass 650 for a full CD")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in Benchmarks]
+    if unknown:
+        parser.error(f"unknown benchmark {', '.join(unknown)} (choose from {', '.join(Benchmarks)})")
+    ImageSizes = args.sizes
+
+    output = os.path.abspath("bench_output.txt")
+    os.chdir(_repo)
+    results = []
+    for name in args.names or list(Benchmarks):
+        Benchmarks[name](results)
+
+    with open(output, 'w') as f:
+        f.write('\n'.join(results) + '\n')
+
+if __name__ == "__main__":
+    main()
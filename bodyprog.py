@@ -6,17 +6,16 @@ import json
 import re
 from collections import namedtuple
 from common import *
+from buildcache import *
+from fingerprint import overlay_fingerprint
 
 _offset = 0x80024B60
-BodyProg = OverlayInfo(0x000cf, 2635, "bodyprog")
-
-def nice_encode(line):
-    return line.replace('\t', '').replace('\n', '{~N}').replace('_', ' ')
-
-def game_encode(line):
-    line = line.replace(' ', '_').replace('{~N}', '\n')
-    line = encode_local_text(line)
-    return line.encode('ascii') + b'\x00'
+# Inventory text block and the item name/description pointer tables that
+# follow each other at 0x800ADB60 and 0x800ADE6C (200 entries read each).
+InventoryRanges = [
+    (0x1b1c, 0x175c),
+    (0x800ADB60 - _offset, 0x800ADE6C + 4*200 - 0x800ADB60),
+]
 
 def extract_inventory_messages(bodyprog: memoryview):
     item_names_ptr = 0x800ADB60 - _offset
@@ -27,8 +26,8 @@ def extract_inventory_messages(bodyprog: memoryview):
             in_ptr = read_uint32_le(bodyprog, item_names_ptr) - _offset
             id_ptr = read_uint32_le(bodyprog, item_descs_ptr) - _offset
             data[i] = {
-                "name": nice_encoding_for_bodyprog(read_c_string(bodyprog, in_ptr)),
-                "desc": nice_encoding_for_bodyprog(read_c_string(bodyprog, id_ptr))
+                "name": decode_inventory(read_c_string(bodyprog, in_ptr)),
+                "desc": decode_inventory(read_c_string(bodyprog, id_ptr))
             }
         except:
             pass
@@ -63,39 +62,71 @@ def patch_inventory(bodyprog: memoryview):
     with open("messages/inventory.json", 'r', encoding="utf-8") as f:
         data = json.load(f)
 
-    for k, v in data.items():
-        itemn_ptr = item_names_ptr + 4*int(k)
-        itemd_ptr = item_descs_ptr + 4*int(k)
-        name = game_encode(v['name'])
-        desc = game_encode(v['desc'])
-
-        txt_pointer = _offset + text_offset
-        patch_pointer(bodyprog, txt_pointer, itemn_ptr)
-        patch_blob(bodyprog, name, text_offset)
-
-        print(f"name={name}, desc={desc}, offset={text_offset:x}")
-
-        text_offset += len(name)
-
-        txt_pointer = _offset + text_offset
-        patch_pointer(bodyprog, txt_pointer, itemd_ptr)
-        patch_blob(bodyprog, desc, text_offset)
-
-        text_offset += len(desc)
-
-        if text_offset > text_max_size:
-            raise MemoryError("Inventory text is too long")
-
-    with open("BODYPROG.BIN", 'wb') as f:
-        f.write(bodyprog)
+    with instrument.span("encode", overlay="bodyprog"):
+        lines = []
+        for k, v in data.items():
+            lines.append(encode_inventory(v['name']))
+            lines.append(encode_inventory(v['desc']))
+
+    with instrument.span("pack", overlay="bodyprog"):
+        txt_blob, offsets, saved = pack_strings(lines)
+    if text_offset + len(txt_blob) > text_max_size:
+        raise MemoryError("Inventory text is too long")
+
+    with instrument.span("patch", overlay="bodyprog", items=len(data)), \
+            PatchJournal(bodyprog, "bodyprog") as journal:
+        journal.write(text_offset, txt_blob)
+        for i, k in enumerate(data):
+            itemn_ptr = item_names_ptr + 4*int(k)
+            itemd_ptr = item_descs_ptr + 4*int(k)
+            name_offset = text_offset + offsets[2*i]
+            desc_offset = text_offset + offsets[2*i + 1]
+            journal.pointer(itemn_ptr, _offset + name_offset)
+            journal.pointer(itemd_ptr, _offset + desc_offset)
+    instrument.count("text block", patched=len(txt_blob) + 8 * len(data),
+                     slack=text_max_size - text_offset - len(txt_blob))
+
+    print(f"inventory: packed text is 0x{len(txt_blob):x} of 0x{text_max_size - text_offset:x} bytes, saved {saved} bytes")
 
 def dump_bodyprog(silent: memoryview):
     bodyprog = xorBodyprog(silent)
     extract_font_width(bodyprog)
     extract_inventory_messages(bodyprog)
 
-def patch_bodyprog(silent: memoryview):
-    bodyprog = xorBodyprog(silent)
-    patch_inventory(bodyprog)
-    xorBodyprog(silent)
+    with open("BODYPROG.BIN", 'wb') as f:
+        f.write(bodyprog)
+
+def inventory_cache_key(silent: memoryview):
+    # The input BODYPROG goes in as its fingerprint
+    return hash_parts(
+        hash_files(__file__, *(sys.modules[name].__file__ for name in ("common", "codec", "cstrings")),
+                   "messages/inventory.json"),
+        json.dumps(LocalCharacters),
+        overlay_fingerprint(silent, BodyProg),
+    )
+
+def patch_bodyprog(silent: memoryview, cache=None):
+    # Only the inventory words are decrypted, patched and encrypted again.
+    bodyprog = extract_overlay(silent, BodyProg)
+    if cache is not None:
+        key = inventory_cache_key(silent)
+        patches = cache.get(key)
+        if patches is not None:
+            for offset, blob in patches:
+                patch_blob(bodyprog, blob, offset)
+            return
+
+    with instrument.span("decrypt"):
+        for offset, size in InventoryRanges:
+            xor_bodyprog_range(bodyprog, offset, size)
+    try:
+        patch_inventory(bodyprog)
+    finally:
+        with instrument.span("encrypt"):
+            for offset, size in InventoryRanges:
+                xor_bodyprog_range(bodyprog, offset, size)
+
+    if cache is not None:
+        patches = [(offset, bodyprog[offset: offset + size].tobytes()) for offset, size in InventoryRanges]
+        cache.put(key, "bodyprog", patches)
 
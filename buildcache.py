@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+
+def hash_parts(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+def hash_files(*paths):
+    parts = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            parts.append(f.read())
+    return hash_parts(*parts)
+
+class BuildCache:
+    # Content-addressed store of the patches a build step produced. Entries
+    # map an input hash to a list of (offset, blob) patches; the blobs live in
+    # objects/ under their own hash so identical ones are stored once.
+    # manifest.json keeps the entries and when they were last used, and the
+    # least recently used ones are evicted past max_entries.
+    def __init__(self, root=".buildcache", max_entries=512):
+        self.root = root
+        self.max_entries = max_entries
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                self.entries = json.load(f)["entries"]
+
+    def _object_path(self, name):
+        return os.path.join(self.root, "objects", name[:2], name[2:])
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        patches = []
+        try:
+            for offset, name in entry["patches"]:
+                with open(self._object_path(name), 'rb') as f:
+                    patches.append((offset, f.read()))
+        except FileNotFoundError:
+            del self.entries[key]
+            self.changed = True
+            return None
+
+        entry["used"] = time.time()
+        self.changed = True
+        return patches
+
+    def put(self, key, label, patches):
+        names = []
+        for offset, blob in patches:
+            name = hashlib.sha1(blob).hexdigest()
+            path = self._object_path(name)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", 'wb') as f:
+                    f.write(blob)
+                os.replace(path + ".tmp", path)
+            names.append([offset, name])
+
+        self.entries[key] = {"label": label, "patches": names, "used": time.time()}
+        self.changed = True
+
+    def evict(self):
+        if len(self.entries) > self.max_entries:
+            by_age = sorted(self.entries, key=lambda k: self.entries[k]["used"])
+            for key in by_age[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+            self.changed = True
+
+        objects = os.path.join(self.root, "objects")
+        if not os.path.isdir(objects):
+            return
+        live = {name for entry in self.entries.values() for _, name in entry["patches"]}
+        for prefix in os.listdir(objects):
+            for rest in os.listdir(os.path.join(objects, prefix)):
+                if prefix + rest not in live:
+                    os.remove(os.path.join(objects, prefix, rest))
+
+    def save(self):
+        if not self.changed:
+            return
+        self.evict()
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.manifest_path + ".tmp", 'w') as f:
+            json.dump({"entries": self.entries}, f, indent=4)
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
+        self.changed = False
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import json
+import sqlite3
+import argparse
+from common import *
+from bodyprog import InventoryRanges
+
+# All the text in one SQLite file, keyed by overlay and entry: the .asciz
+# sources with their .tr.txt translations and the offsets from info.*, the
+# messages/map*.json dumps and messages/inventory.json. The text files stay
+# what translators edit; the catalog imports a file again when its size or
+# time changed, one overlay at a time, so a tool can ask for a single
+# overlay without reading the rest. Catalog.export writes edits made through
+# the catalog back in the same formats; until then an overlay with edits isn't
+# imported again over them when its file changes, sync and export say so and
+# --force picks a side.
+#
+# Translations keep their exact text between the ------- separators, so an
+# export writes back the same bytes it imported.
+CatalogPath = "catalog.db"
+
+Overlay = namedtuple("Overlay", ["name", "kind", "text_address", "text_offset", "text_size",
+                                 "ptr_offset", "count", "stamp"])
+Entry = namedtuple("Entry", ["overlay", "entry", "key", "address", "source", "translation"])
+
+_schema = """
+create table if not exists overlays (
+    name text primary key,
+    kind text not null,
+    text_address integer,
+    text_offset integer,
+    text_size integer,
+    ptr_offset integer,
+    count integer,
+    stamp text
+);
+create table if not exists entries (
+    overlay text not null references overlays(name) on delete cascade,
+    entry integer not null,
+    key text,
+    address integer,
+    source text,
+    translation text,
+    primary key (overlay, entry)
+) without rowid;
+create index if not exists entries_source on entries(source);
+create index if not exists entries_translation on entries(translation);
+create table if not exists edits (
+    overlay text primary key
+);
+"""
+
+_separator = '\n-------'
+
+def split_tr(content):
+    # The entries of a .tr.txt as written, without the new line after each
+    # separator; strip() them for the text read_translated_lines gives
+    parts = content.split(_separator)
+    return parts[:1] + [part[1:] if part.startswith('\n') else part for part in parts[1:]]
+
+def join_tr(entries):
+    return (_separator + '\n').join(entries)
+
+def _stamp(*paths):
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps.append(f"{st.st_size}:{st.st_mtime_ns}")
+        except OSError:
+            stamps.append("-")
+    return ' '.join(stamps)
+
+def _hex(value):
+    return int(value, 16) if value is not None else None
+
+class Catalog:
+    def __init__(self, path=CatalogPath):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("pragma foreign_keys = on")
+        self.db.executescript(_schema)
+        self.warned = set()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # What each overlay is read from; the name of an .asciz overlay is the
+    # .asciz file, the others are named by their JSON file
+    def sources(self, name, kind):
+        if kind == "asciz":
+            return [name, name + ".tr.txt", "info." + name]
+        return [name]
+
+    def _replace(self, overlay, entries):
+        self.db.execute("delete from entries where overlay = ?", (overlay.name,))
+        self.db.execute("delete from edits where overlay = ?", (overlay.name,))
+        self.db.execute("insert or replace into overlays values (?, ?, ?, ?, ?, ?, ?, ?)", overlay)
+        self.db.executemany("insert into entries values (?, ?, ?, ?, ?, ?)",
+                            [(overlay.name, i, key, address, source, translation)
+                             for i, (key, address, source, translation) in enumerate(entries)])
+
+    def import_asciz(self, name):
+        asciz = load_asciz(name)
+        translations = []
+        if os.path.exists(name + ".tr.txt"):
+            with open(name + ".tr.txt", "r", encoding="utf-8") as f:
+                translations = split_tr(f.read())
+        info = {}
+        if os.path.exists("info." + name):
+            with open("info." + name, 'r') as f:
+                info = json.load(f)
+
+        # Text past the last entry (the empty one after the last separator)
+        # is kept as entries without a source
+        entries = []
+        for i in range(max(len(asciz), len(translations))):
+            source = asciz.strings[i] if i < len(asciz) else None
+            address = asciz.addresses[i] if i < len(asciz) else None
+            entries.append((None, address, source, translations[i] if i < len(translations) else None))
+        self._replace(Overlay(name, "asciz", asciz.base, _hex(info.get("text-ptr")), len(asciz.text_blob()),
+                              _hex(info.get("pointers")), len(asciz), _stamp(*self.sources(name, "asciz"))),
+                      entries)
+
+    def import_map_json(self, path):
+        # The dumps hold the game's text, edited in place into the translation
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        entries = [(None, None, None, message) for message in data['messages']]
+        self._replace(Overlay(path, "map", None, _hex(data['txt-offset']), _hex(data['txt-size']),
+                              _hex(data['ptr-offset']), _hex(data['ptr-size']), _stamp(path)), entries)
+
+    def import_inventory(self, path="messages/inventory.json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        entries = []
+        for item, texts in data.items():
+            entries += [(f"{item}.{field}", None, None, texts[field]) for field in ("name", "desc")]
+        text_offset, text_size = InventoryRanges[0]
+        self._replace(Overlay(path, "inventory", None, text_offset, text_size, InventoryRanges[1][0],
+                              len(data), _stamp(path)), entries)
+
+    def import_file(self, name, kind):
+        if kind == "asciz":
+            self.import_asciz(name)
+        elif kind == "map":
+            self.import_map_json(name)
+        else:
+            self.import_inventory(name)
+
+    def edited(self):
+        # The overlays with edits that aren't exported yet
+        return {name for name, in self.db.execute("select overlay from edits")}
+
+    def sync(self, names=None, force=False):
+        # Imports what changed since the last import; returns the names imported.
+        # A changed file whose overlay has unexported edits is skipped unless
+        # force, which drops the edits.
+        if names is None:
+            names = [(path[:-len(".tr.txt")], "asciz") for path in sorted(glob.glob("*.asciz.tr.txt"))]
+            names += [(path, "map") for path in sorted(glob.glob("messages/map*.json"))]
+            if os.path.exists("messages/inventory.json"):
+                names.append(("messages/inventory.json", "inventory"))
+        stamps = dict(self.db.execute("select name, stamp from overlays"))
+        edited = self.edited()
+        imported = []
+        for name, kind in names:
+            if stamps.get(name) != _stamp(*self.sources(name, kind)):
+                if name in edited and not force:
+                    if name not in self.warned:
+                        print(f"warning: {name} changed on disk but has edits made through the catalog "
+                              f"that aren't exported, not imported (export --force writes the edits "
+                              f"over the file, sync --force drops them)")
+                        self.warned.add(name)
+                    continue
+                self.import_file(name, kind)
+                imported.append(name)
+        self.db.commit()
+        return imported
+
+    def overlays(self):
+        return [Overlay(*row) for row in self.db.execute("select * from overlays order by name")]
+
+    def overlay(self, name):
+        # One overlay, imported again first if its files changed
+        row = self.db.execute("select * from overlays where name = ?", (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        overlay = Overlay(*row)
+        if overlay.stamp != _stamp(*self.sources(name, overlay.kind)):
+            self.sync([(name, overlay.kind)])
+            overlay = Overlay(*self.db.execute("select * from overlays where name = ?", (name,)).fetchone())
+        return overlay
+
+    def entries(self, name):
+        self.overlay(name)
+        return [Entry(*row) for row in
+                self.db.execute("select * from entries where overlay = ? order by entry", (name,))]
+
+    def translated_lines(self, name):
+        # What read_translated_lines gives for the overlay's .tr.txt
+        return [(e.translation or '').strip() for e in self.entries(name)]
+
+    def find(self, source=None, translation=None):
+        # Every entry with this source or translation text, through the indexes
+        if source is not None:
+            rows = self.db.execute("select * from entries where source = ?", (source,))
+        else:
+            rows = self.db.execute("select * from entries where translation = ?", (translation,))
+        return [Entry(*row) for row in rows]
+
+    def set_translation(self, name, entry, text):
+        self.db.execute("update entries set translation = ? where overlay = ? and entry = ?", (text, name, entry))
+        self.db.execute("insert or ignore into edits values (?)", (name,))
+
+    def export(self, name, force=False):
+        # Writes the overlay's translations back into the file they came from.
+        # A file changed since the import isn't overwritten with edits unless
+        # force.
+        overlay = self.overlay(name)
+        if not force and name in self.edited() and overlay.stamp != _stamp(*self.sources(name, overlay.kind)):
+            raise ValueError(f"{name} changed on disk since the catalog's edits to it, "
+                             f"export --force writes them over it, sync --force drops them")
+        entries = self.entries(name)
+        if overlay.kind == "asciz":
+            with open(name + ".tr.txt", 'w', encoding='utf-8') as f:
+                f.write(join_tr([e.translation or '' for e in entries]))
+        elif overlay.kind == "map":
+            output = {
+                "txt-offset": f"0x{overlay.text_offset:X}",
+                "ptr-offset": f"0x{overlay.ptr_offset:X}",
+                "txt-size"  : f"0x{overlay.text_size:X}",
+                "ptr-size"  : f"0x{overlay.count:X}",
+                "messages"  : [e.translation for e in entries],
+            }
+            with open(name, 'w') as f:
+                json.dump(output, f, indent=4)
+        else:
+            data = {}
+            for e in entries:
+                item, field = e.key.split('.')
+                data.setdefault(item, {})[field] = e.translation
+            with open(name, 'w') as f:
+                json.dump(data, f, indent=4)
+        self.db.execute("update overlays set stamp = ? where name = ?",
+                        (_stamp(*self.sources(name, overlay.kind)), name))
+        self.db.execute("delete from edits where overlay = ?", (name,))
+        self.db.commit()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Keep the translations in one indexed SQLite catalog")
+    parser.add_argument("--db", default=CatalogPath, help=f"the catalog (default: {CatalogPath})")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sync = sub.add_parser("sync", help="import the text files that changed since the last sync")
+    sync.add_argument("--force", action="store_true",
+                      help="import changed files even over edits that weren't exported")
+    show = sub.add_parser("show", help="print an overlay's entries")
+    show.add_argument("overlay")
+    find = sub.add_parser("find", help="list the entries with this source text (as in the .asciz)")
+    find.add_argument("source")
+    export = sub.add_parser("export", help="write overlays back to their text files")
+    export.add_argument("overlays", nargs="*", help="default: all")
+    export.add_argument("--force", action="store_true",
+                        help="write the edits even over files that changed since they were imported")
+    args = parser.parse_args(argv)
+
+    with Catalog(args.db) as catalog:
+        if args.command == "sync":
+            imported = catalog.sync(force=args.force)
+            print(f"imported {len(imported)} files, {len(catalog.overlays())} in {args.db}")
+        elif args.command == "show":
+            for e in catalog.entries(args.overlay):
+                print(f"{e.entry + 1}: {e.source!r}\n    {e.translation!r}")
+        elif args.command == "find":
+            for e in catalog.find(args.source):
+                print(f"{e.overlay}:{e.entry + 1} {(e.translation or '').strip()!r}")
+        elif args.command == "export":
+            catalog.sync()
+            for name in args.overlays or [o.name for o in catalog.overlays()]:
+                try:
+                    catalog.export(name, args.force)
+                    print(f"exported {name}")
+                except ValueError as e:
+                    print(f"error with {name}, {e}")
+
+if __name__ == "__main__":
+    main()
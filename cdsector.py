@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import struct
+from array import array
+
+# Raw CD images (.bin) store 2352 byte sectors. The game disc is Mode 2, every
+# data sector is Form 1:
+#   0x000  sync (00 ff*10 00)
+#   0x00c  header: minute, second, frame (BCD), mode
+#   0x010  subheader, twice
+#   0x018  2048 bytes of user data
+#   0x818  EDC, CRC32 of 0x010-0x817
+#   0x81c  ECC, P parity (172 bytes) then Q parity (104 bytes)
+# A cooked .iso only has the 2048 user bytes of each sector.
+SECTOR_SIZE = 2352
+USER_OFFSET = 0x18
+USER_SIZE = 0x800
+_SYNC = b'\x00' + b'\xff' * 10 + b'\x00'
+_EDC_OFFSET = 0x818
+_P_OFFSET = 0x81c
+_Q_OFFSET = 0x8c8
+
+def is_raw_image(data):
+    return len(data) % SECTOR_SIZE == 0 and data[:12] == _SYNC
+
+def is_cd_image(data):
+    if is_raw_image(data):
+        return True
+    return data[16 * USER_SIZE: 16 * USER_SIZE + 6] == b'\x01CD001'
+
+class SectorLayout:
+    def __init__(self, data):
+        self.data = data
+        self.raw = is_raw_image(data)
+        self.sector_size = SECTOR_SIZE if self.raw else USER_SIZE
+        self.user_offset = USER_OFFSET if self.raw else 0
+
+    def offset(self, lba):
+        # Offset of the user data of sector lba in the image file
+        return lba * self.sector_size + self.user_offset
+
+    def user_data(self, lba):
+        if self.raw:
+            sector = lba * SECTOR_SIZE
+            if self.data[sector + 15] != 2 or self.data[sector + 18] & 0x20:
+                raise ValueError(f"sector {lba} is not a Mode 2 Form 1 sector")
+        start = self.offset(lba)
+        return self.data[start: start + USER_SIZE]
+
+# ISO9660 lookup, only what is needed to find a file's extent
+def _directory_entry(read_sector, lba, size, name):
+    for i in range((size + USER_SIZE - 1) // USER_SIZE):
+        sector = read_sector(lba + i)
+        pos = 0
+        while pos < USER_SIZE and sector[pos]:
+            extent, length = struct.unpack_from('<I4xI', sector, pos + 2)
+            name_len = sector[pos + 32]
+            entry = bytes(sector[pos + 33: pos + 33 + name_len]).decode('ascii', 'replace')
+            if entry.split(';')[0].rstrip('.').upper() == name:
+                return extent, length
+            pos += sector[pos]
+
+    raise FileNotFoundError(f"{name} is not on the disc")
+
+def iso_find(read_sector, path):
+    pvd = read_sector(16)
+    if pvd[:6] != b'\x01CD001':
+        raise ValueError("no ISO9660 volume descriptor")
+
+    lba, size = struct.unpack_from('<I4xI', pvd, 156 + 2)
+    for name in path.strip('/').upper().split('/'):
+        lba, size = _directory_entry(read_sector, lba, size, name)
+    return lba, size
+
+# EDC/ECC. Instead of running the CRC and the Reed-Solomon parity one sector
+# at a time, every byte position is handled for all sectors at once: a column
+# of that byte across the sectors is one strided slice, GF(2^8) lookups are
+# bytes.translate tables and XORs are done on the column as one big integer.
+# A whole disc costs about as many Python operations as a single sector.
+def _make_tables():
+    edc = [bytearray(256) for _ in range(4)]
+    ecc_f = bytearray(256)
+    ecc_b = bytearray(256)
+    for i in range(256):
+        j = (i << 1) ^ (0x11d if i & 0x80 else 0)
+        ecc_f[i] = j
+        ecc_b[i ^ j] = i
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (0xd8018001 if crc & 1 else 0)
+        for lane in range(4):
+            edc[lane][i] = (crc >> (8 * lane)) & 0xff
+    return [bytes(t) for t in edc], bytes(ecc_f), bytes(ecc_b)
+
+_edc_lanes, _ecc_f, _ecc_b = _make_tables()
+
+def _ecc_indices(major_count, minor_count, major_mult, minor_inc):
+    size = major_count * minor_count
+    indices = []
+    for major in range(major_count):
+        index = (major >> 1) * major_mult + (major & 1)
+        column = array('H')
+        for _ in range(minor_count):
+            column.append(index)
+            index += minor_inc
+            if index >= size:
+                index -= size
+        indices.append(column)
+    return indices
+
+_p_indices = _ecc_indices(86, 24, 2, 86)
+_q_indices = _ecc_indices(52, 43, 86, 88)
+
+def _column(buf, offset):
+    return int.from_bytes(buf[offset::SECTOR_SIZE], 'little')
+
+def _edc(buf, count):
+    c0 = c1 = c2 = c3 = 0
+    t0, t1, t2, t3 = _edc_lanes
+    for offset in range(0x10, _EDC_OFFSET):
+        index = (c0 ^ _column(buf, offset)).to_bytes(count, 'little')
+        c0 = c1 ^ int.from_bytes(index.translate(t0), 'little')
+        c1 = c2 ^ int.from_bytes(index.translate(t1), 'little')
+        c2 = c3 ^ int.from_bytes(index.translate(t2), 'little')
+        c3 = int.from_bytes(index.translate(t3), 'little')
+    for lane, crc in enumerate((c0, c1, c2, c3)):
+        buf[_EDC_OFFSET + lane::SECTOR_SIZE] = crc.to_bytes(count, 'little')
+
+def _ecc(buf, count, indices, dest):
+    majors = len(indices)
+    for major, column in enumerate(indices):
+        a = b = 0
+        for index in column:
+            t = _column(buf, 0xc + index)
+            a = int.from_bytes((a ^ t).to_bytes(count, 'little').translate(_ecc_f), 'little')
+            b ^= t
+        a = int.from_bytes(a.to_bytes(count, 'little').translate(_ecc_f), 'little') ^ b
+        a = int.from_bytes(a.to_bytes(count, 'little').translate(_ecc_b), 'little')
+        buf[dest + major::SECTOR_SIZE] = a.to_bytes(count, 'little')
+        buf[dest + major + majors::SECTOR_SIZE] = (a ^ b).to_bytes(count, 'little')
+
+def regenerate_sectors(buf):
+    # Recomputes EDC and ECC of the Mode 2 Form 1 sectors in buf, in place.
+    # The header takes part in the ECC as zeros in Mode 2.
+    count = len(buf) // SECTOR_SIZE
+    if not count:
+        return
+
+    header = [buf[0xc + i::SECTOR_SIZE] for i in range(4)]
+    for i in range(4):
+        buf[0xc + i::SECTOR_SIZE] = bytes(count)
+    _edc(buf, count)
+    _ecc(buf, count, _p_indices, _P_OFFSET)
+    _ecc(buf, count, _q_indices, _Q_OFFSET)
+    for i in range(4):
+        buf[0xc + i::SECTOR_SIZE] = header[i]
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import shlex
+import importlib
+
+# One entry point for all the tools: `cli.py <command> [args]`. A command's
+# module is only imported when the command runs, so `cli.py` alone, `--help`
+# and the quick commands don't load the whole build. `cli.py script FILE`
+# runs one command per line in this process, so a batch of commands pays for
+# the interpreter and the imports once. `cli.py --time <command>` prints how
+# long the command and its imports took; bench.py tracks the startup times.
+Commands = {
+    "extract":     ("extract_translated_text", "write an .asciz's .tr.txt from the game"),
+    "dump":        (None, "dump the map messages, the inventory and the font widths from SILENT"),
+    "patch":       ("translate_silent", "build the translated image or patches"),
+    "messages":    (None, "patch the map messages and the inventory from messages/ into SILENT"),
+    "verify":      ("verify", "check a build against its input and the translations"),
+    "report":      ("preflight", "check every translation fits its text block"),
+    "layout":      ("layout", "check or reflow line widths"),
+    "tm":          ("tm", "translation memory: consistency checks and fills"),
+    "catalog":     ("catalog", "the SQLite catalog of all text"),
+    "fingerprint": ("fingerprint", "check an input image overlay by overlay"),
+    "freespace":   ("freespace", "list the free space at the end of every map overlay"),
+    "apply":       ("patchfile", "apply a .ppf or .ips patch"),
+    "batch":       ("batch_build", "build several translation sets and images"),
+    "font":        ("functions", "dump the font sheet of SILENT"),
+    "bench":       ("bench", "benchmark the build on synthetic data"),
+}
+
+def usage():
+    print("usage: cli.py [--time] <command> [args]\n\ncommands:")
+    for name, (_, description) in Commands.items():
+        print(f"  {name:<12} {description}")
+    print(f"  {'script':<12} run the commands in a file, one per line")
+
+def dump(argv):
+    import argparse
+    import maps
+    import bodyprog
+    from common import DiscImage, SectorFile, is_cd_image
+
+    parser = argparse.ArgumentParser(prog="cli.py dump", description=Commands["dump"][1])
+    parser.add_argument("silent", help="SILENT, or a disc image holding it")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="dump the maps in this many processes (0 = one per core)")
+    args = parser.parse_args(argv)
+
+    image = DiscImage(args.silent)
+    member = None
+    if is_cd_image(image.data):
+        image, member = SectorFile(image, "SILENT"), "SILENT"
+    os.makedirs("messages", exist_ok=True)
+    maps.dump_maps(image.view, args.silent, args.jobs, member)
+    bodyprog.dump_bodyprog(image.view)
+
+def messages(argv):
+    # The other half of dump: the edited messages/*.json go back in
+    import argparse
+    import maps
+    import bodyprog
+    from common import DiscImage, SectorFile, is_cd_image
+    from buildcache import BuildCache
+
+    parser = argparse.ArgumentParser(prog="cli.py messages", description=Commands["messages"][1])
+    parser.add_argument("silent", help="SILENT, or a disc image holding it")
+    parser.add_argument("out", help="the patched copy of it")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="patch the maps in this many processes (0 = one per core)")
+    parser.add_argument("--spill", action="store_true",
+                        help="move messages that don't fit their block into the zeros at the end of the "
+                             "overlay instead of failing, as translate_silent.py --spill")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="patch the inventory again instead of replaying .buildcache")
+    args = parser.parse_args(argv)
+
+    image = DiscImage(args.silent)
+    member = None
+    if is_cd_image(image.data):
+        image, member = SectorFile(image, "SILENT"), "SILENT"
+    with image:
+        maps.patch_maps(image.view, args.silent, args.jobs, member, args.spill)
+        cache = None if args.no_cache else BuildCache()
+        bodyprog.patch_bodyprog(image.view, cache)
+        if cache is not None:
+            cache.save()
+        image.save(args.out)
+
+def run(argv):
+    # Runs one command; returns its exit status
+    if not argv or argv[0] in ("-h", "--help"):
+        usage()
+        return 0
+    name, args = argv[0], argv[1:]
+    if name == "script":
+        return script(args[0]) if args else usage() or 2
+    if name not in Commands:
+        print(f"unknown command {name}")
+        usage()
+        return 2
+
+    # argparse names the program after sys.argv[0]
+    prog = sys.argv[0]
+    sys.argv[0] = f"cli.py {name}"
+    try:
+        if name == "dump":
+            dump(args)
+        elif name == "messages":
+            messages(args)
+        else:
+            importlib.import_module(Commands[name][0]).main(args)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code)
+        return 1
+    finally:
+        sys.argv[0] = prog
+    return 0
+
+def script(path):
+    # Every line is a command; blank lines and # comments are skipped
+    failed = 0
+    with open(path, 'r') as f:
+        for line in f:
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+            status = run(argv)
+            if status:
+                print(f"{line.strip()}: exit status {status}")
+                failed += 1
+    return 1 if failed else 0
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    timed = argv[:1] == ["--time"]
+    if timed:
+        argv = argv[1:]
+    start = time.perf_counter()
+    status = run(argv)
+    if timed:
+        print(f"{' '.join(argv[:1])}: {(time.perf_counter() - start) * 1000:.1f} ms, "
+              f"{len(sys.modules)} modules loaded", file=sys.stderr)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
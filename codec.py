@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import re
+import json
+from functools import lru_cache
+
+# Polish letters and the unused ASCII glyphs the font draws them with
+LocalCharacters = {
+    'ł': ';', 'ó': '*', 'ę': '>', 'ą': '^', 'ż': '=',
+    'ć': '<', 'ń': '+', 'ś': '/', 'ź': 'Q',
+}
+
+# Every format below is a translate table for the per-character part and,
+# where the control codes have to be spaced out, one regex pass over the
+# control-code grammar:
+#   ~Cn ~Sn ~Ln      colour, selection, position (one digit argument)
+#   ~D ~H ~E ~M ~T   no argument, ~N is a line break
+#   ~Jn(n.n)\t       cutscene timing, always followed by a tab
+_local_table = str.maketrans(LocalCharacters)
+_unlocal_table = str.maketrans({v: k for k, v in LocalCharacters.items()})
+
+def encode_local_text(line):
+    return line.translate(_local_table)
+
+def decode_local_text(line):
+    return line.translate(_unlocal_table)
+
+# Encoders work on bytes: once the Polish letters are swapped for their glyphs
+# the text is ASCII and bytes.translate is much cheaper than str.translate.
+_local_bytes = [(char.encode('utf-8'), glyph.encode('ascii')) for char, glyph in LocalCharacters.items()]
+
+def _game_bytes(txt):
+    line = txt.encode('utf-8')
+    if not txt.isascii():
+        for char, glyph in _local_bytes:
+            line = line.replace(char, glyph)
+        if not line.isascii():
+            # raises the same UnicodeEncodeError as encoding to ascii did
+            encode_local_text(txt).encode('ascii')
+    return line
+
+# Plain text (*.tr.txt): spaces and underscores swap, new lines become ~N
+_plain_table = bytes.maketrans(b' _', b'_ ')
+
+@lru_cache(maxsize=None)
+def encode_plain(txt):
+    return _game_bytes(txt).translate(_plain_table).replace(b'\n', b' ~N ')
+
+# Game text -> the translate.* dump: visible spaces only, tabs dropped except
+# after ~J(..), ~N as a new line and every other code surrounded by a space.
+# The dump used to be made with one regex pass per code letter, which leaves
+# two spaces between back to back codes of the same letter; that is kept so
+# the dumps don't change.
+_strip_spaces = str.maketrans({'_': ' ', ' ': None})
+_game_token = re.compile(r'~[CSL]\d|~[DHEM]|~N|\)\t|[ \t\n]|[^~) \t\n]+|[~)]')
+
+@lru_cache(maxsize=None)
+def decode_plain(msg):
+    out = []
+    ws = ''
+    after_code = None
+    for m in _game_token.finditer(msg.translate(_strip_spaces)):
+        t = m.group()
+        if t == '\t' or t == '\n':
+            continue
+        if t == ' ' or t == '~N':
+            ws += '\n' if t == '~N' else ' '
+            continue
+        if t[0] == '~' and len(t) >= 2:
+            out.append('  ' + t if after_code == t[1] else ' ' + t)
+            ws, after_code = '', t[1]
+            continue
+        out.append(' ' if after_code else ws)
+        out.append(t[0] if t == ')\t' else t)
+        ws, after_code = '\t' if t == ')\t' else '', None
+
+    out.append(' ' if after_code else ws)
+    msg = ''.join(out)
+    return msg[1:] if msg.startswith(' ~') else msg
+
+# messages/mapN_sNN.json: codes wrapped in {} instead of spaces
+_braced_strip = str.maketrans({' ': None, '\n': None, '\t': None, '_': ' '})
+_braced_codes = re.compile(r'(~[CLS]\d|~[MDHETN]|~J\d\(\d+\.\d+\))')
+_braced_table = bytes.maketrans(b' {}', b'_  ')
+
+@lru_cache(maxsize=None)
+def decode_braced(line):
+    return _braced_codes.sub(r'{\1}', line.translate(_braced_strip)).strip()
+
+@lru_cache(maxsize=None)
+def encode_braced(line):
+    return _game_bytes(line).translate(_braced_table) + b'\x00'
+
+# messages/inventory.json: only ~N is used and written as {~N}
+_inventory_strip = str.maketrans({'\t': None, '_': ' '})
+_inventory_table = bytes.maketrans(b' ', b'_')
+
+@lru_cache(maxsize=None)
+def decode_inventory(line):
+    return line.translate(_inventory_strip).replace('\n', '{~N}')
+
+@lru_cache(maxsize=None)
+def encode_inventory(line):
+    return _game_bytes(line).translate(_inventory_table).replace(b'{~N}', b'\n') + b'\x00'
+
+# Another language swaps in its own letters -> glyphs table. LocalCharacters
+# is changed in place so every module that imported it sees the new table.
+def set_local_characters(table):
+    global _local_table, _unlocal_table, _local_bytes
+    LocalCharacters.clear()
+    LocalCharacters.update(table)
+    _local_table = str.maketrans(LocalCharacters)
+    _unlocal_table = str.maketrans({v: k for k, v in LocalCharacters.items()})
+    _local_bytes = [(char.encode('utf-8'), glyph.encode('ascii')) for char, glyph in LocalCharacters.items()]
+    for fn in (encode_plain, encode_braced, encode_inventory):
+        fn.cache_clear()
+
+def load_local_characters(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        table = json.load(f)
+    for char, glyph in table.items():
+        if len(char) != 1 or len(glyph) != 1 or not glyph.isascii():
+            raise ValueError(f"{path}: {char!r} -> {glyph!r} is not one character to one ASCII glyph")
+    return table
+
+def encode_overlay(lines, encode=encode_plain):
+    return [encode(line) + b'\x00' for line in lines]
+
+def decode_overlay(msgs, decode=decode_plain):
+    return [decode(msg) for msg in msgs]
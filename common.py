@@ -1,52 +1,556 @@
 #!/usr/bin/env python3
 
 import sys
+import os
 import struct
 import json
 import re
+import mmap
+import shutil
+import ctypes
+import io
+import contextlib
+import traceback
 from collections import namedtuple
+from array import array
+from bisect import bisect_right
+from codec import *
+from asciz import *
+from cdsector import *
+from cstrings import *
+from cstrings import _nul
+import instrument
 
 OverlayInfo = namedtuple("OverlayInfo", ["sector_start", "block_size", "filename"])
+BodyProg = OverlayInfo(0x000cf, 2635, "bodyprog")
 
-def extract_overlay(silent: memoryview, ovi: OverlayInfo):
+# Every map overlay of SILENT: its sectors, whether it has the messages table
+# maps.py dumps and patches (the five short ones don't) and whether its text
+# is split into an .asciz for translate_silent. Both tools read this table.
+MapOverlay = namedtuple("MapOverlay", ["sector_start", "block_size", "filename", "messages", "asciz"])
+MapOverlays = [
+    MapOverlay(0x092af,  422, "map0_s00", True,  True),
+    MapOverlay(0x092e4,  401, "map0_s01", True,  True),
+    MapOverlay(0x09317,  160, "map0_s02", True,  True),
+    MapOverlay(0x0932b,  381, "map1_s00", True,  True),
+    MapOverlay(0x0935b,  349, "map1_s01", True,  True),
+    MapOverlay(0x09387,  454, "map1_s02", True,  True),
+    MapOverlay(0x093c0,  463, "map1_s03", True,  True),
+    MapOverlay(0x093fa,   75, "map1_s04", False, True),
+    MapOverlay(0x09404,  242, "map1_s05", True,  True),
+    MapOverlay(0x09423,  284, "map1_s06", True,  True),
+    MapOverlay(0x09447,  708, "map2_s00", True,  True),
+    MapOverlay(0x094a0,  131, "map2_s01", True,  True),
+    MapOverlay(0x094b1,  631, "map2_s02", True,  True),
+    MapOverlay(0x09500,   74, "map2_s03", False, True),
+    MapOverlay(0x0950a,   95, "map2_s04", True,  True),
+    MapOverlay(0x09516,  201, "map3_s00", True,  True),
+    MapOverlay(0x09530,  243, "map3_s01", True,  True),
+    MapOverlay(0x0954f,  156, "map3_s02", True,  True),
+    MapOverlay(0x09563,  240, "map3_s03", True,  True),
+    MapOverlay(0x09581,  217, "map3_s04", True,  True),
+    MapOverlay(0x0959d,  320, "map3_s05", True,  True),
+    MapOverlay(0x095c5,  203, "map3_s06", True,  True),
+    MapOverlay(0x095df,   64, "map4_s00", False, True),
+    MapOverlay(0x095e7,  236, "map4_s01", True,  True),
+    MapOverlay(0x09605,  639, "map4_s02", True,  True),
+    MapOverlay(0x09655,  373, "map4_s03", True,  False),
+    MapOverlay(0x09684,  218, "map4_s04", True,  True),
+    MapOverlay(0x096a0,  293, "map4_s05", True,  True),
+    MapOverlay(0x096c5,   64, "map4_s06", False, True),
+    MapOverlay(0x096cd,  335, "map5_s00", True,  True),
+    MapOverlay(0x096f7,  682, "map5_s01", True,  True),
+    MapOverlay(0x0974d,  277, "map5_s02", True,  True),
+    MapOverlay(0x09770,  220, "map5_s03", True,  True),
+    MapOverlay(0x0978c,  684, "map6_s00", True,  True),
+    MapOverlay(0x097e2,  193, "map6_s01", True,  True),
+    MapOverlay(0x097fb,  185, "map6_s02", True,  True),
+    MapOverlay(0x09813,  363, "map6_s03", True,  True),
+    MapOverlay(0x09841,  586, "map6_s04", True,  True),
+    MapOverlay(0x0988b,   65, "map6_s05", False, True),
+    MapOverlay(0x09894,  175, "map7_s00", True,  True),
+    MapOverlay(0x098aa,  415, "map7_s01", True,  True),
+    MapOverlay(0x098de,  559, "map7_s02", True,  True),
+    MapOverlay(0x09924,  698, "map7_s03", True,  True),
+]
+
+# The overlays translate_silent patches, named by their .asciz
+Overlays = [ovi.filename + ".asciz" for ovi in MapOverlays if ovi.asciz]
+
+def read_translated_lines(infile):
+    with open(infile, "r", encoding="utf-8") as f:
+        content = f.read()
+
+    return [entry.strip() for entry in content.split('\n-------') ]
+
+def overlay_range(ovi: OverlayInfo):
+    # (start, end) of the overlay in SILENT
     start = (ovi.sector_start - 0x40) * 0x800
-    size  = ovi.block_size * 0x100
+    return start, start + ovi.block_size * 0x100
+
+def map_overlay(filename):
+    # The MapOverlay of map0_s00 or map0_s00.asciz, None for other files
+    name = filename[:-len(".asciz")] if filename.endswith(".asciz") else filename
+    for ovi in MapOverlays:
+        if ovi.filename == name:
+            return ovi
+    return None
+
+def extract_overlay(silent: memoryview, ovi: OverlayInfo):
+    start, end = overlay_range(ovi)
+    return silent[start: end]
 
-    return silent[start: start+size]
+_LCG_ADD = 0x01309125
+_LCG_MUL = 0x03a452f7
+_keystream_cache = {}
+
+def lcg_seed_at(index: int) -> int:
+    # Seed used for word `index`, i.e. the LCG advanced index+1 times from 0.
+    # Each step is the affine map s -> M*s + A*M, so n steps are composed by
+    # squaring instead of iterating.
+    step_mul = _LCG_MUL
+    step_add = (_LCG_ADD * _LCG_MUL) & 0xffffffff
+    mul, add = 1, 0
+    n = index + 1
+    while n:
+        if n & 1:
+            mul = (mul * step_mul) & 0xffffffff
+            add = (add * step_mul + step_add) & 0xffffffff
+        step_add = (step_add * step_mul + step_add) & 0xffffffff
+        step_mul = (step_mul * step_mul) & 0xffffffff
+        n >>= 1
+    return add
+
+def bodyprog_keystream(count: int, first: int = 0) -> bytes:
+    if first == 0 and count in _keystream_cache:
+        return _keystream_cache[count]
+
+    seed = lcg_seed_at(first - 1) if first else 0
+    words = array('I', bytes(4 * count))
+    for i in range(count):
+        seed = ((seed + _LCG_ADD) * _LCG_MUL) & 0xffffffff
+        words[i] = seed
+
+    key = words.tobytes()
+    if first == 0:
+        _keystream_cache[count] = key
+    return key
+
+def xor_blob(dstblob, key: bytes):
+    size = len(key)
+    x = int.from_bytes(dstblob[:size], 'little') ^ int.from_bytes(key, 'little')
+    dstblob[:size] = x.to_bytes(size, 'little')
+    mark_dirty(dstblob, 0, size)
+
+def xor_bodyprog_range(bodyprog: memoryview, offset: int, size: int):
+    # Decrypts or re-encrypts only the words covering [offset, offset+size).
+    first = offset // 4
+    last = min((offset + size + 3) // 4, len(bodyprog) // 4)
+    if last <= first:
+        return
+    xor_blob(bodyprog[first*4: last*4], bodyprog_keystream(last - first, first))
 
 #based on https://github.com/Vatuu/silent-hill-decomp/blob/master/tools/silentassets/extract.py
 def xorBodyprog(silent: memoryview):
     bodyprog = extract_overlay(silent, BodyProg)
-    outArray = bodyprog.cast("I") # uint32_t
-    seed = 0
-
-    for i, value in enumerate(outArray):
-        seed = (seed + 0x01309125) & 0xffffffff
-        seed = (seed * 0x03a452f7) & 0xffffffff
-        outArray[i] ^= seed
-
+    xor_blob(bodyprog, bodyprog_keystream(len(bodyprog) // 4))
     return bodyprog
 
 def read_uint32_le(buf, offset):
     return struct.unpack_from('<I', buf, offset)[0]
 
 def read_c_string(data: memoryview, offset: int) -> str:
-    end = offset
-    while end < len(data) and data[end] != 0:
-        end += 1
-    return data[offset:end].tobytes().decode('ascii')
+    m = _nul.search(data, offset)
+    end = m.start() if m else len(data)
+    return bytes(data[offset:end]).decode('ascii')
 
 def patch_blob(dstblob, srcblob, offset):
     bloblen = len(srcblob)
     dstblob[offset: offset + bloblen] = srcblob
+    mark_dirty(dstblob, offset, bloblen)
 
 def patch_pointer(dstblob, pointer, offset):
-    srcblob = struct.pack('<I', pointer)
-    patch_blob(dstblob, srcblob, offset)
+    struct.pack_into('<I', dstblob, offset, pointer)
+    mark_dirty(dstblob, offset, 4)
+
+class PatchJournal:
+    # The writes of one patch step, held back until commit(): blobs and
+    # pointers are buffered, pointers at consecutive words are packed into one
+    # array('I') and writes that touch or overlap are merged (a later write
+    # wins), so the buffer gets one write per run. A step that raises before
+    # commit() leaves the buffer as it was; used as a context manager the
+    # journal commits when the block ends and drops the writes on an error.
+    # After commit() the old bytes are kept and rollback() puts them back.
+    def __init__(self, dstblob, name=None):
+        self.dstblob = dstblob
+        self.name = name
+        self.writes = []
+        self.words = {}
+        self.undo = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def write(self, offset, data):
+        self.flush_words()
+        self.writes.append((offset, bytes(data)))
+
+    def pointer(self, offset, value):
+        self.words[offset] = value
+
+    def pointers(self, offset, values):
+        self.write(offset, le_words(array('I', values)))
+
+    def flush_words(self):
+        # Turns the single pointers into one write per run of consecutive words
+        if not self.words:
+            return
+        offsets = sorted(self.words)
+        start = 0
+        for i in range(1, len(offsets) + 1):
+            if i == len(offsets) or offsets[i] != offsets[i - 1] + 4:
+                run = offsets[start: i]
+                self.writes.append((run[0], le_words(array('I', [self.words[o] for o in run]))))
+                start = i
+        self.words = {}
+
+    def patches(self):
+        # [(offset, bytes)] of the merged runs, in offset order
+        self.flush_words()
+        runs = []
+        for start, end in sorted((offset, offset + len(data)) for offset, data in self.writes):
+            if runs and start <= runs[-1][1]:
+                runs[-1][1] = max(runs[-1][1], end)
+            else:
+                runs.append([start, end])
+
+        starts = [start for start, _ in runs]
+        blobs = [bytearray(end - start) for start, end in runs]
+        for offset, data in self.writes:
+            i = bisect_right(starts, offset) - 1
+            blobs[i][offset - starts[i]: offset - starts[i] + len(data)] = data
+        return [(start, bytes(blob)) for start, blob in zip(starts, blobs)]
+
+    def diff(self):
+        # [(offset, old, new)] of the runs that change bytes
+        return [(offset, bytes(self.dstblob[offset: offset + len(data)]), data)
+                for offset, data in self.patches()
+                if self.dstblob[offset: offset + len(data)] != data]
+
+    def size(self):
+        return sum(len(data) for _, data in self.patches())
+
+    def commit(self):
+        patches = self.patches()
+        self.undo = [(offset, bytes(self.dstblob[offset: offset + len(data)])) for offset, data in patches]
+        for offset, data in patches:
+            patch_blob(self.dstblob, data, offset)
+        self.writes = []
+
+    def rollback(self):
+        # Drops the buffered writes and undoes a commit
+        self.writes = []
+        self.words = {}
+        for offset, data in reversed(self.undo or []):
+            patch_blob(self.dstblob, data, offset)
+        self.undo = None
+
+def pack_strings(strings):
+    # Lays out NUL terminated strings so that duplicates are stored once and a
+    # string that is the tail of a longer one points into it ("Take it? ~S4"
+    # inside "...~N Take it? ~S4"). Sorting by the reversed bytes puts every
+    # string right before the ones it is a suffix of.
+    # Returns the blob, the offset of every input string and the bytes saved.
+    unique = list(dict.fromkeys(strings))
+    by_suffix = sorted(unique, key=lambda s: s[::-1])
+    host = {}
+    for i in range(len(by_suffix) - 1, -1, -1):
+        s = by_suffix[i]
+        if i + 1 < len(by_suffix) and by_suffix[i + 1].endswith(s):
+            host[s] = host[by_suffix[i + 1]]
+        else:
+            host[s] = s
+
+    blob = bytearray()
+    placed = {}
+    for s in unique:
+        if host[s] is s:
+            placed[s] = len(blob)
+            blob += s
+
+    offsets = [placed[host[s]] + len(host[s]) - len(s) for s in strings]
+    saved = sum(len(s) for s in strings) - len(blob)
+    return bytes(blob), offsets, saved
+
+_FICLONE = 0x40049409
+_open_images = []
+
+def _buffer_address(buf):
+    return ctypes.addressof(ctypes.c_char.from_buffer(buf))
+
+def mark_dirty(dstblob, offset, size):
+    # Records a write made through any view (extract_overlay slices included)
+    # into an open DiscImage. Buffers that aren't part of an image are ignored.
+    if not _open_images or size <= 0:
+        return
+    try:
+        address = _buffer_address(dstblob) + offset
+    except (TypeError, ValueError):
+        return
+    for image in _open_images:
+        start = address - image.address
+        if 0 <= start < image.size:
+            image.dirty.append((start, start + size))
+
+def clone_file(src, dst):
+    with open(src, 'rb') as fi, open(dst, 'wb') as fo:
+        try:
+            import fcntl
+            fcntl.ioctl(fo.fileno(), _FICLONE, fi.fileno())
+            return
+        except (ImportError, OSError):
+            pass
+
+        size = os.fstat(fi.fileno()).st_size
+        copied = 0
+        try:
+            while copied < size:
+                n = os.copy_file_range(fi.fileno(), fo.fileno(), size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except (AttributeError, OSError):
+            fi.seek(copied)
+            fo.seek(copied)
+            shutil.copyfileobj(fi, fo)
+
+class DiscImage:
+    # The input file is mapped copy-on-write: patches only touch the pages they
+    # write to and are remembered as dirty ranges, so saving is a file clone
+    # plus a pwrite per range instead of rewriting the whole image.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.view = memoryview(self.data)
+        self.size = len(self.data)
+        self.address = _buffer_address(self.data)
+        self.dirty = []
+        _open_images.append(self)
+
+    def dirty_ranges(self):
+        ranges = []
+        for start, end in sorted(self.dirty):
+            if ranges and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], end)
+            else:
+                ranges.append([start, end])
+        return [(start, end) for start, end in ranges]
+
+    def save(self, path):
+        if not (os.path.exists(path) and os.path.samefile(path, self.path)):
+            clone_file(self.path, path)
+
+        self.update(path, self.dirty_ranges())
+
+    def update(self, path, ranges):
+        # Writes `ranges` into a copy made by an earlier save()
+        with open(path, 'r+b') as f:
+            for start, end in ranges:
+                os.pwrite(f.fileno(), self.view[start:end], start)
+
+    def patches_since(self, mark):
+        # Patches recorded after len(self.dirty) was `mark`, as (offset, bytes)
+        dirty, self.dirty = self.dirty, self.dirty[mark:]
+        ranges = self.dirty_ranges()
+        self.dirty = dirty
+        return [(start, self.view[start:end].tobytes()) for start, end in ranges]
+
+    def restore(self, start, end):
+        self.view[start:end] = os.pread(self.file.fileno(), end - start, start)
+
+    def close(self):
+        # Takes the image out of the ones mark_dirty looks through and unmaps
+        # it; a view still held elsewhere keeps its mapping until it goes away
+        if self in _open_images:
+            _open_images.remove(self)
+        try:
+            self.view.release()
+            self.data.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SectorFile(DiscImage):
+    # One file of a CD image (e.g. SILENT in the .bin) seen as a flat buffer.
+    # In a raw image its 2048 byte payloads are split by sector headers and
+    # EDC/ECC, so the file is gathered into memory, patched there like any
+    # DiscImage and written back sector by sector on save, with EDC/ECC
+    # regenerated for the sectors that changed.
+    def __init__(self, image, name):
+        self.image = image
+        self.path = image.path
+        self.file = image.file
+        # reads come from the input file, writes go to the image on flush()
+        self.original = mmap.mmap(image.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.layout = SectorLayout(self.original)
+        self.lba, self.size = iso_find(self.layout.user_data, name)
+        self.data = bytearray(self.read(0, self.size))
+        self.view = memoryview(self.data)
+        self.address = _buffer_address(self.data)
+        self.dirty = []
+        _open_images.append(self)
+
+    def sectors(self, start, end):
+        # (lba, offset in the sector, offset in the file, length) covering start-end
+        while start < end:
+            offset = start % USER_SIZE
+            size = min(end - start, USER_SIZE - offset)
+            yield self.lba + start // USER_SIZE, offset, start, size
+            start += size
+
+    def read(self, start, end):
+        return b''.join(self.layout.user_data(lba)[offset: offset + size]
+                        for lba, offset, _, size in self.sectors(start, end))
+
+    def restore(self, start, end):
+        self.view[start:end] = self.read(start, end)
+
+    def close(self):
+        if self in _open_images:
+            _open_images.remove(self)
+        try:
+            self.view.release()
+            self.original.close()
+        except BufferError:
+            pass
+        self.image.close()
+
+    def flush(self, ranges=None):
+        # Writes the file ranges (all dirty ones by default) into their
+        # sectors and returns the image ranges that changed
+        touched = set()
+        written = []
+        for start, end in self.dirty_ranges() if ranges is None else ranges:
+            for lba, offset, pos, size in self.sectors(start, end):
+                image_offset = self.layout.offset(lba) + offset
+                patch_blob(self.image.data, self.view[pos: pos + size], image_offset)
+                written.append((image_offset, image_offset + size))
+                touched.add(lba)
+
+        if self.layout.raw and touched:
+            touched = sorted(touched)
+            raw = self.image.view
+            buf = bytearray(b''.join(raw[lba * SECTOR_SIZE: (lba + 1) * SECTOR_SIZE] for lba in touched))
+            regenerate_sectors(buf)
+            for i, lba in enumerate(touched):
+                start = i * SECTOR_SIZE
+                patch_blob(self.image.data, buf[start + USER_OFFSET + USER_SIZE: start + SECTOR_SIZE],
+                           lba * SECTOR_SIZE + USER_OFFSET + USER_SIZE)
+                written.append((lba * SECTOR_SIZE + USER_OFFSET + USER_SIZE, (lba + 1) * SECTOR_SIZE))
+        return written
+
+    def save(self, path):
+        self.flush()
+        self.image.save(path)
+
+    def update(self, path, ranges):
+        self.image.update(path, self.flush(ranges))
+
+def open_image(path, member=None):
+    # member names a file inside a CD image to patch instead of the whole file
+    image = DiscImage(path)
+    if member is None:
+        return image
+    return SectorFile(image, member)
+
+_worker_images = {}
+
+def _overlay_job(job):
+    path, member, func, item, args, trace = job
+    instrument.start_worker(trace)
+    image = _worker_images.get((path, member))
+    if image is None:
+        image = _worker_images[path, member] = open_image(path, member)
+
+    out = io.StringIO()
+    error = None
+    with contextlib.redirect_stdout(out):
+        try:
+            func(image, item, *args)
+        except Exception as e:
+            error = (e, traceback.format_exc())
+
+    # Hand the patched bytes back and undo them, so the next overlay this
+    # worker gets sees the input image again.
+    patches = []
+    for start, end in image.dirty_ranges():
+        patches.append((start, image.view[start:end].tobytes()))
+        image.restore(start, end)
+    image.dirty = []
+
+    return item, out.getvalue(), error, patches, instrument.drain()
+
+def run_overlays_parallel(path, func, items, args=(), jobs=None, member=None):
+    # Runs func(image, item, *args) for every item in a process pool. Each
+    # worker maps the input image itself, so nothing big crosses processes
+    # except the patched bytes. Results come back in the order of items.
+    # imported here, the process pool machinery takes a third of the startup
+    from concurrent.futures import ProcessPoolExecutor
+    trace = instrument.worker_config()
+    work = [(path, member, func, item, args, trace) for item in items]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for item, out, error, patches, events in pool.map(_overlay_job, work):
+            instrument.merge(events)
+            yield item, out, error, patches
+
+class PatchOverlapError(Exception):
+    pass
 
-def encode_local_text(line):
-    line = line.replace('ł', ';').replace('ó', '*').replace('ę', '>').replace('ą', '^')
-    line = line.replace('ż', '=').replace('ć', '<').replace('ń', '+').replace('ś', '/').replace('ź', 'Q')
-    return line
+def check_patches(owner, patches, written):
+    # `written` maps start -> (end, owner, data) for everything merged so far.
+    # Overlaps are only allowed when both sides write the same bytes, e.g. the
+    # identical overlays that all locate the same blobs.
+    for start, data in patches:
+        end = start + len(data)
+        for other_start, (other_end, other_owner, other_data) in written.items():
+            if start < other_end and other_start < end:
+                lo, hi = max(start, other_start), min(end, other_end)
+                if data[lo-start: hi-start] != other_data[lo-other_start: hi-other_start]:
+                    raise PatchOverlapError(f"{owner} and {other_owner} both patch 0x{lo:x}-0x{hi:x}")
 
+def merge_patches(dstblob, owner, patches, written):
+    check_patches(owner, patches, written)
+    for start, data in patches:
+        patch_blob(dstblob, data, start)
+        written[start] = (start + len(data), owner, data)
 
+def check_patched(image, owner, patches, written):
+    # merge_patches for patches already written into image (patches_since):
+    # on an overlap they are taken back, the input bytes restored and what
+    # the other owners wrote there written again, then the error is raised
+    try:
+        check_patches(owner, patches, written)
+    except PatchOverlapError:
+        for start, data in patches:
+            end = start + len(data)
+            image.restore(start, end)
+            for other_start, (other_end, _, other_data) in written.items():
+                if start < other_end and other_start < end:
+                    lo, hi = max(start, other_start), min(end, other_end)
+                    image.view[lo:hi] = other_data[lo-other_start: hi-other_start]
+        raise
+    for start, data in patches:
+        written[start] = (start + len(data), owner, data)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+from bisect import bisect_left
+from array import array
+
+# Bulk reading of NUL terminated strings. Instead of looking for the end of
+# every string on its own, all terminators of a text block are found in one
+# regex pass over the buffer (re works on memoryviews and mmaps without a
+# copy) and every string is matched to the first NUL at or after its start.
+# The strings are slices of the buffer that are only copied when decoded.
+_nul = re.compile(b'\x00')
+
+class CString:
+    __slots__ = ('data', 'start', 'end')
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __bytes__(self):
+        return bytes(self.data[self.start: self.end])
+
+    def __str__(self):
+        return self.decode()
+
+    def __repr__(self):
+        return f"CString(0x{self.start:x}, {bytes(self)!r})"
+
+    @property
+    def view(self):
+        return memoryview(self.data)[self.start: self.end]
+
+    def decode(self, encoding='ascii'):
+        return bytes(self).decode(encoding)
+
+# start/end: the bytes from the first string to the NUL of the last one,
+# padding: the NULs between strings that align them (the compiler pads every
+# string to 4 bytes), i.e. room a new text block can use.
+class StringTable:
+    __slots__ = ('strings', 'start', 'end', 'padding')
+
+    def __init__(self, strings, start, end, padding):
+        self.strings = strings
+        self.start = start
+        self.end = end
+        self.padding = padding
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __iter__(self):
+        return iter(self.strings)
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def decode(self, encoding='ascii'):
+        return [s.decode(encoding) for s in self.strings]
+
+def find_terminators(data, start, end):
+    return [m.start() for m in _nul.finditer(data, start, end)]
+
+def read_strings(data, offsets):
+    if not offsets:
+        return StringTable([], 0, 0, 0)
+
+    starts = sorted(set(offsets))
+    last = _nul.search(data, starts[-1])
+    if last is None:
+        raise ValueError(f"string at 0x{starts[-1]:x} has no terminator")
+    nuls = find_terminators(data, starts[0], last.end())
+
+    ends = {start: nuls[bisect_left(nuls, start)] for start in starts}
+    padding = 0
+    for prev, start in zip(starts, starts[1:]):
+        padding += max(0, start - ends[prev] - 1)
+    strings = [CString(data, offset, ends[offset]) for offset in offsets]
+    return StringTable(strings, starts[0], last.start(), padding)
+
+def read_pointers(data, offset, end=None, count=None):
+    # The .word table at offset, up to end or count words or a NULL pointer
+    if count is None:
+        count = (end - offset) // 4
+    words = array('I')
+    words.frombytes(bytes(data[offset: offset + 4 * count]))
+    if sys.byteorder == 'big':
+        words.byteswap()
+    if 0 in words:
+        del words[words.index(0):]
+    return words
+
+def read_string_table(data, ptr_offset, ptr_end=None, count=None, base=0):
+    # The strings of a pointer table; pointers are addresses, base is the
+    # address data starts at
+    pointers = read_pointers(data, ptr_offset, ptr_end, count)
+    return read_strings(data, [p - base for p in pointers])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from common import *
+from maps import OverlayInfos
+
+# Fingerprints of SILENT: a SHA-1 of every overlay's sector range, BODYPROG
+# included, and of the data between them in 8 MiB pieces, so together they
+# cover the whole file. hashlib lets go of the GIL while it hashes, so the
+# regions are hashed by a pool of threads. A mismatch names the overlay
+# that differs, and an overlay's hash is a cheap cache key for anything built
+# from it.
+FingerprintManifest = "fingerprints.json"
+_chunk_size = 8 << 20
+
+def overlay_fingerprint(silent, ovi):
+    return hashlib.sha1(extract_overlay(silent, ovi)).hexdigest()
+
+def fingerprint_regions(size, overlays=None):
+    # (name, start, end) of every region of a SILENT of `size` bytes
+    if overlays is None:
+        overlays = [BodyProg] + OverlayInfos
+    regions = []
+    for ovi in overlays:
+        start = min(size, (ovi.sector_start - 0x40) * 0x800)
+        regions.append((ovi.filename, start, min(size, start + ovi.block_size * 0x100)))
+
+    pos = 0
+    for _, start, end in sorted(regions, key=lambda r: r[1]) + [(None, size, size)]:
+        for chunk in range(pos, start, _chunk_size):
+            regions.append((f"data@{chunk:x}", chunk, min(start, chunk + _chunk_size)))
+        pos = max(pos, end)
+    return regions
+
+def fingerprint(silent, jobs=None, overlays=None):
+    regions = fingerprint_regions(len(silent), overlays)
+    with ThreadPoolExecutor(jobs) as pool:
+        digests = pool.map(lambda r: hashlib.sha1(silent[r[1]: r[2]]).hexdigest(), regions)
+        return {"size": len(silent), "regions": dict(zip((r[0] for r in regions), digests))}
+
+def open_silent(path):
+    # SILENT itself, or SILENT inside a CD image
+    image = DiscImage(path)
+    if is_cd_image(image.data):
+        image = SectorFile(image, "SILENT")
+    return image
+
+def compare_fingerprints(expected, actual):
+    # Names of the regions that differ; a size change is reported as "size"
+    differ = [] if expected["size"] == actual["size"] else ["size"]
+    names = list(expected["regions"]) + [n for n in actual["regions"] if n not in expected["regions"]]
+    for name in names:
+        if expected["regions"].get(name) != actual["regions"].get(name):
+            differ.append(name)
+    return differ
+
+def load_manifest(path=FingerprintManifest):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(prints, path=FingerprintManifest):
+    with open(path, 'w') as f:
+        json.dump(prints, f, indent=4)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check SILENT (or a disc image) overlay by overlay")
+    parser.add_argument("image")
+    parser.add_argument("--manifest", default=FingerprintManifest,
+                        help=f"known-good fingerprints (default: {FingerprintManifest})")
+    parser.add_argument("--record", action="store_true",
+                        help="write the image's fingerprints to the manifest instead of checking them")
+    parser.add_argument("--against", metavar="IMAGE",
+                        help="compare with this image instead of the manifest, e.g. a build with its input")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="hashing threads (0 = one per core)")
+    args = parser.parse_args(argv)
+
+    prints = fingerprint(open_silent(args.image).view, args.jobs or None)
+    if args.record:
+        save_manifest(prints, args.manifest)
+        print(f"{args.manifest}: {len(prints['regions'])} regions of {args.image}")
+        return
+
+    if args.against:
+        expected = fingerprint(open_silent(args.against).view, args.jobs or None)
+    else:
+        try:
+            expected = load_manifest(args.manifest)
+        except FileNotFoundError:
+            sys.exit(f"no {args.manifest}; record one from a known-good image with --record")
+
+    differ = compare_fingerprints(expected, prints)
+    for name in differ:
+        print(f"{name}: differs")
+    print(f"{len(prints['regions']) - len(differ)} of {len(prints['regions'])} regions match")
+    sys.exit(1 if differ else 0)
+
+if __name__ == "__main__":
+    main()
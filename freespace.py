@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import argparse
+from bisect import insort
+from common import *
+
+# Room for text that doesn't fit its block. The padding between the original
+# strings and their stripped tabs and new lines are reused already: the
+# whole old block is packed again. Past that, an overlay's file is padded
+# with zeros up to block_size * 0x100, and with --spill the zeros at its end
+# are handed out by a free list; strings that don't fit move there, the
+# largest first, and their pointers point at the new place. Nothing checks
+# that those zeros are padding and not the end of the overlay's .data (a
+# table or variables that start out zero), so spilling is opt-in and warns
+# every time. Zero runs inside an overlay are only listed, never allocated.
+#
+# The zero runs are found by bytes.rstrip and bytes.find over a copy of the
+# overlay, which run in C (a regex or a loop over the bytes is several times
+# slower). The first zero after a string is its terminator and is never free.
+_zeros = re.compile(rb'\x00*')
+MinRun = 64
+
+def _align(n, align=4):
+    return (n + align - 1) & ~(align - 1)
+
+def zero_tail(data, start=0, end=None):
+    # (start, end) of the zeros that end data[start:end]
+    end = len(data) if end is None else end
+    last = len(bytes(data[start:end]).rstrip(b'\x00'))
+    tail = start if last == 0 else start + _align(last + 1)
+    return (tail, end) if tail < end else None
+
+def zero_runs(data, start=0, end=None, min_size=MinRun):
+    # [(start, end)] of the runs of at least min_size zeros, aligned
+    end = len(data) if end is None else end
+    chunk = bytes(data[start:end])
+    zeros = bytes(min_size + 1)
+    runs = []
+    pos = chunk.find(zeros)
+    while pos != -1:
+        run_end = _zeros.match(chunk, pos).end()
+        run_start = _align(pos + 1)
+        if run_end - run_start >= min_size:
+            runs.append((start + run_start, start + run_end))
+        pos = chunk.find(zeros, run_end)
+    return runs
+
+class FreeList:
+    # Free [start, end) regions of one buffer; alloc() takes the smallest
+    # region the size fits in, so large regions stay for large strings
+    def __init__(self, regions=(), name=None):
+        self.name = name
+        self.regions = []
+        for start, end in regions:
+            self.free(start, end - start)
+
+    def __len__(self):
+        return sum(end - start for start, end in self.regions)
+
+    def exclude(self, start, end):
+        # Takes a range that is in use out of the free regions
+        regions = []
+        for s, e in self.regions:
+            if e <= start or s >= end:
+                regions.append((s, e))
+                continue
+            if s < start:
+                regions.append((s, start))
+            if e > end:
+                regions.append((end, e))
+        self.regions = regions
+
+    def alloc(self, size, align=1):
+        best = None
+        for i, (start, end) in enumerate(self.regions):
+            offset = _align(start, align)
+            if offset + size <= end and (best is None or end - start < best[2]):
+                best = (i, offset, end - start)
+        if best is None:
+            raise MemoryError(f"Not enough free space in {self.name} for {size} more bytes")
+
+        i, offset, _ = best
+        start, end = self.regions.pop(i)
+        if start < offset:
+            insort(self.regions, (start, offset))
+        if offset + size < end:
+            insort(self.regions, (offset + size, end))
+        return offset
+
+    def free(self, offset, size):
+        start, end = offset, offset + size
+        regions = []
+        for s, e in self.regions:
+            if e < start or s > end:
+                regions.append((s, e))
+            else:
+                start, end = min(start, s), max(end, e)
+        regions.append((start, end))
+        self.regions = sorted(regions)
+
+def overlay_bounds(offset, size):
+    # (start, end) in SILENT of the map overlay holding [offset, offset + size)
+    for ovi in MapOverlays:
+        start = (ovi.sector_start - 0x40) * 0x800
+        end = start + ovi.block_size * 0x100
+        if start <= offset and offset + size <= end:
+            return start, end
+    return None
+
+def overlay_free_list(data, start, end, used=(), name=None):
+    # The free list of the overlay in data[start:end]: its zero tail, without
+    # the ranges in use
+    tail = zero_tail(data, start, end)
+    free = FreeList([tail] if tail else [], name)
+    for used_start, used_end in used:
+        free.exclude(used_start, used_end)
+    return free
+
+def text_free_list(data, offset, size, used=(), name=None):
+    # The free list of the map overlay holding the text block at offset, or
+    # None when data is a whole disc (the overlay bounds are SILENT offsets)
+    # or no overlay holds the block. A tail another patch filled already
+    # isn't zero anymore, so it isn't handed out twice.
+    if is_cd_image(data):
+        return None
+    bounds = overlay_bounds(offset, size)
+    if bounds is None:
+        return None
+    start, end = bounds
+    return overlay_free_list(data, start, min(end, len(data)), used, name)
+
+def pack_with_spill(encoded, room, free=None, name=None):
+    # Packs the strings into `room` bytes; when they don't fit, the largest
+    # ones move out into `free` until the rest does. Returns the blob, the
+    # offset of every string (into the blob, or None for the moved ones), the
+    # moved strings as {string: offset} and the bytes saved by sharing.
+    moved = {}
+    while True:
+        staying = [s for s in encoded if s not in moved]
+        txt_blob, offsets, saved = pack_strings(staying)
+        overflow = len(txt_blob) - room
+        if overflow <= 0:
+            break
+        if free is None:
+            raise MemoryError("Not enough room for the new text")
+
+        # move out at least the overflow, the largest strings first
+        for s in sorted(dict.fromkeys(staying), key=len, reverse=True):
+            moved[s] = None
+            overflow -= len(s)
+            if overflow <= 0:
+                break
+
+    for s in moved:
+        moved[s] = free.alloc(len(s))
+    if moved:
+        print(f"warning: {name}: moved {len(moved)} strings, 0x{sum(map(len, moved)):x} bytes, into the "
+              f"zeros at the end of the overlay (0x{len(free):x} bytes left); nothing checks the game "
+              f"doesn't use them, test {name} in the game")
+        instrument.count("spilled", strings=len(moved), bytes=sum(map(len, moved)))
+
+    placed = iter(offsets)
+    offsets = [None if s in moved else next(placed) for s in encoded]
+    return txt_blob, offsets, moved, saved
+
+def print_free_space(data, overlays):
+    total = 0
+    for ovi in overlays:
+        start = (ovi.sector_start - 0x40) * 0x800
+        end = min(len(data), start + ovi.block_size * 0x100)
+        if start >= end:
+            continue
+        tail = zero_tail(data, start, end)
+        size = tail[1] - tail[0] if tail else 0
+        runs = zero_runs(data, start, tail[0] if tail else end)
+        total += size
+        print(f"{ovi.filename:<10} tail 0x{size:05x} bytes", end='')
+        if runs:
+            print(f", {len(runs)} zero runs inside of 0x{sum(e - s for s, e in runs):x} bytes (not used)", end='')
+        print()
+    print(f"0x{total:x} bytes free in the tails of {len(overlays)} overlays")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the free space of the map overlays of SILENT")
+    parser.add_argument("silent", help="SILENT, or a disc image holding it")
+    args = parser.parse_args(argv)
+
+    image = DiscImage(args.silent)
+    if is_cd_image(image.data):
+        image = SectorFile(image, "SILENT")
+    print_free_space(image.view, MapOverlays)
+
+if __name__ == "__main__":
+    main()
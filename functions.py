@@ -8,11 +8,17 @@ from collections import namedtuple
 from bodyprog import *
 from textures import *
 
-def main():
-    silent_path = sys.argv[1]
-    with open(silent_path, 'rb') as f:
-        data = bytearray(f.read())
-        silent = memoryview(data)
+def main(argv=None):
+    argv = sys.argv if argv is None else [sys.argv[0]] + list(argv)
+    if len(argv) not in (2, 3):
+        print("Usage: functions.py <SILENT or disc image> [out]")
+        sys.exit(1)
+    silent_path = argv[1]
+    image = DiscImage(silent_path)
+    if is_cd_image(image.data):
+        # the whole disc: work on SILENT inside it, EDC/ECC is fixed on save
+        image = SectorFile(image, "SILENT")
+    silent = image.view
 
     #xorBodyprog(silent)
 
@@ -24,16 +30,16 @@ def main():
     #extract_bodyprog_messages(silent)
 
     #patch_bodyprog(silent)
-    #with open(silent_path+".new", 'wb') as f:
-    #    f.write(silent)
+    #image.save(silent_path+".new")
 
     #dump_bodyprog(silent)
     dump_font(silent)
-    with open("/home/oxi/.wine/drive_c/users/oxi/AppData/Local/Temp/SILENT", 'wb') as f:
-        f.write(silent)
+    if len(argv) == 3:
+        image.save(argv[2])
 
-def dump_data(memoryview: silent):
+def dump_data(silent: memoryview):
     dump_font(silent)
     dump_bodyprog(silent)
 
-main()
+if __name__ == "__main__":
+    main()
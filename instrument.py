@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import json
+import threading
+import tracemalloc
+
+# Build instrumentation, written as a Chrome trace (load it in chrome://tracing
+# or ui.perfetto.dev). Spans record wall and CPU time, counters record sizes.
+# Everything is off until enable() is called; span() then hands out one shared
+# no-op context manager and count() returns right away.
+class _Off:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+_off = _Off()
+_trace = None
+
+class _Span:
+    __slots__ = ('trace', 'name', 'args', 'start', 'cpu')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def __enter__(self):
+        if self.trace.memory:
+            self.trace.push_peak()
+        self.cpu = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        cpu = time.thread_time_ns() - self.cpu
+        if self.trace.memory:
+            self.args["peak-bytes"] = self.trace.pop_peak()
+        self.args["cpu-ms"] = round(cpu / 1e6, 3)
+        self.trace.events.append({
+            "name": self.name, "ph": "X", "pid": self.trace.pid, "tid": threading.get_ident(),
+            "ts": (self.start - self.trace.epoch) / 1000, "dur": (end - self.start) / 1000,
+            "args": self.args,
+        })
+        return False
+
+class Trace:
+    def __init__(self, path=None, memory=False, epoch=None):
+        self.path = path
+        self.memory = memory
+        self.pid = os.getpid()
+        self.epoch = time.perf_counter_ns() if epoch is None else epoch
+        self.events = []
+        self.peaks = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def push_peak(self):
+        # tracemalloc has one peak; keep the parent's so far before resetting
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+        self.peaks.append(0)
+        tracemalloc.reset_peak()
+
+    def pop_peak(self):
+        peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], peak)
+        tracemalloc.reset_peak()
+        return peak
+
+    def count(self, name, values):
+        self.events.append({
+            "name": name, "ph": "C", "pid": self.pid,
+            "ts": (time.perf_counter_ns() - self.epoch) / 1000, "args": values,
+        })
+
+    def save(self):
+        # json.dumps goes through the C encoder, json.dump to a file doesn't
+        with open(self.path, 'w') as f:
+            f.write(json.dumps({"traceEvents": self.events, "displayTimeUnit": "ms"}))
+
+def enable(path, memory=False):
+    global _trace
+    _trace = Trace(path, memory)
+
+def enabled():
+    return _trace is not None
+
+def span(name, **args):
+    if _trace is None:
+        return _off
+    return _Span(_trace, name, args)
+
+def count(name, **values):
+    if _trace is not None:
+        _trace.count(name, values)
+
+def finish():
+    global _trace
+    if _trace is not None and _trace.path:
+        _trace.save()
+    _trace = None
+
+# Worker processes record into their own Trace and hand the events back with
+# their results; perf_counter is the same clock in every process on one
+# machine, so the parent's epoch lines them up.
+def worker_config():
+    if _trace is None:
+        return None
+    return (_trace.memory, _trace.epoch)
+
+def start_worker(config):
+    global _trace
+    if config is None:
+        _trace = None
+    elif _trace is None or _trace.pid != os.getpid():
+        # a forked worker inherits the parent's trace, events included
+        memory, epoch = config
+        _trace = Trace(memory=memory, epoch=epoch)
+
+def drain():
+    if _trace is None:
+        return []
+    events, _trace.events = _trace.events, []
+    return events
+
+def merge(events):
+    if _trace is not None:
+        _trace.events += events
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import json
+import argparse
+from common import *
+
+# The font width table in BODYPROG covers the glyphs 0x27-0x7a. As in
+# extract_font_width, '!' is drawn with the glyph in the '\' slot and '&' with
+# the one in the '^' slot; the Polish letters need no special case because
+# lines are measured after encoding, i.e. on the ASCII glyphs they became.
+FontWidthOffset = 0x80025D6C - 0x80024B60
+FontFirstGlyph = 0x27
+FontGlyphs = 84
+_renamed = {'!': '\\', '&': '^'}
+
+# Control codes take no room; spaces, tabs and the new lines the .asciz
+# sources keep after ~N only separate them from the text
+_codes = re.compile(rb'~[CSL]\d|~J\d\([\d.]*\)\t?|~[DHEMT]|[ \t\r\n]')
+
+class FontMetrics:
+    def __init__(self, table):
+        table = bytes(table)
+        self.widths = array('B', [max(table)] * 256)
+        for i, width in enumerate(table):
+            self.widths[FontFirstGlyph + i] = width
+        for drawn, slot in _renamed.items():
+            self.widths[ord(drawn)] = self.widths[ord(slot)]
+        self.space = self.widths[ord('_')]
+        self._lines = {}
+
+    @classmethod
+    def from_json(cls, path="messages/font_info.json"):
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        table = bytearray(FontGlyphs)
+        for char, width in data.items():
+            table[ord(_renamed.get(char, char)) - FontFirstGlyph] = width
+        return cls(table)
+
+    @classmethod
+    def from_silent(cls, silent):
+        # Decrypts just the words of the table, BODYPROG itself is left alone
+        bodyprog = extract_overlay(silent, BodyProg)
+        first = FontWidthOffset // 4
+        count = (FontWidthOffset % 4 + FontGlyphs + 3) // 4
+        words = bytes(bodyprog[first * 4: (first + count) * 4])
+        plain = (int.from_bytes(words, 'little') ^ int.from_bytes(bodyprog_keystream(count, first), 'little'))
+        plain = plain.to_bytes(count * 4, 'little')
+        start = FontWidthOffset % 4
+        return cls(plain[start: start + FontGlyphs])
+
+    def measure_line(self, line):
+        # Width in pixels of one line of encoded text
+        width = self._lines.get(line)
+        if width is None:
+            width = sum(map(self.widths.__getitem__, _codes.sub(b'', line)))
+            self._lines[line] = width
+        return width
+
+    def measure(self, text, newline=b'~N'):
+        # Widths of every line of an encoded message
+        return [self.measure_line(line) for line in text.rstrip(b'\x00').split(newline)]
+
+def load_metrics(silent=None):
+    # From the game when SILENT is at hand, else from the extract_font_width dump
+    if silent is not None:
+        return FontMetrics.from_silent(silent)
+    if os.path.exists("messages/font_info.json"):
+        return FontMetrics.from_json()
+    return None
+
+# Checking. Without an explicit limit the widest line of the original game
+# text is used: everything the game shipped with fits its dialog box.
+Overflow = namedtuple("Overflow", ["source", "entry", "line", "width", "max_width", "text"])
+
+def max_line_width(metrics, messages, newline=b'~N'):
+    return max((max(metrics.measure(msg, newline)) for msg in messages), default=0)
+
+def original_messages(overlays):
+    messages = []
+    for ov in overlays:
+        messages += [s.encode('latin-1') for s in load_asciz(ov).strings]
+    return messages
+
+def check_lines(metrics, source, encoded, max_width, newline=b'~N'):
+    overflows = []
+    for entry, text in enumerate(encoded):
+        for line, width in enumerate(metrics.measure(text, newline)):
+            if width > max_width:
+                content = text.rstrip(b'\x00').split(newline)[line].decode('ascii', 'replace')
+                overflows.append(Overflow(source, entry, line, width, max_width, content))
+    return overflows
+
+def read_tr_lines(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [entry.strip() for entry in f.read().split('\n-------')]
+
+def check_overlays(metrics, overlays, max_width=None):
+    if max_width is None:
+        max_width = max_line_width(metrics, original_messages(overlays))
+
+    overflows = []
+    for ov in overlays:
+        try:
+            lines = read_tr_lines(ov + ".tr.txt")[:len(load_asciz(ov))]
+        except OSError:
+            continue
+        overflows += check_lines(metrics, ov + ".tr.txt", encode_overlay(lines), max_width)
+    return overflows
+
+def check_inventory(metrics, max_width=None, path="messages/inventory.json", original="bodyprog.asciz"):
+    if max_width is None:
+        max_width = max_line_width(metrics, original_messages([original]), b'\n')
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    encoded = []
+    for item in data.values():
+        encoded += [encode_inventory(item['name']), encode_inventory(item['desc'])]
+    return check_lines(metrics, path, encoded, max_width, b'\n')
+
+def report_overflows(overflows):
+    for o in overflows:
+        print(f"{o.source}: entry {o.entry + 1} line {o.line + 1} is {o.width}px, "
+              f"{o.width - o.max_width}px too wide: {o.text}")
+
+# Reflow. Every space or new line in a .tr.txt entry may become a line break;
+# the breaks are chosen to keep all lines but the last as evenly filled as
+# possible (minimum raggedness: the sum of the squared free room is minimal).
+# A ~E waits for a button and starts a new page, so it always ends a line.
+_breakable = re.compile(r'[ \n]')
+
+def _atom_width(metrics, atom):
+    return metrics.measure_line(encode_plain(atom))
+
+def _break_lines(widths, space, max_width, forced):
+    # best[i]: cost of laying out atoms i.. ; nxt[i]: where the line from i ends
+    n = len(widths)
+    best = [0] * (n + 1)
+    nxt = [n] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        best[i] = None
+        width = -space
+        for j in range(i, n):
+            width += widths[j] + space
+            if width > max_width and j > i:
+                break
+            last = j + 1 == n
+            cost = (0 if last else (max_width - width) ** 2) + best[j + 1]
+            if best[i] is None or cost < best[i]:
+                best[i] = cost
+                nxt[i] = j + 1
+            if j in forced:
+                break
+    lines = []
+    i = 0
+    while i < n:
+        lines.append((i, nxt[i]))
+        i = nxt[i]
+    return lines
+
+def reflow(metrics, text, max_width):
+    atoms = _breakable.split(text.strip())
+    widths = [_atom_width(metrics, atom) for atom in atoms]
+    forced = {i for i, atom in enumerate(atoms) if atom.endswith('~E') and i + 1 < len(atoms)}
+    lines = _break_lines(widths, metrics.space, max_width, forced)
+    return '\n'.join(' '.join(atoms[i:j]) for i, j in lines)
+
+def reflow_file(metrics, path, max_width):
+    entries = read_tr_lines(path)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n-------\n'.join(reflow(metrics, entry, max_width) if entry else entry
+                                  for entry in entries))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check or reflow translated text against the game font")
+    parser.add_argument("overlays", nargs="+", help=".asciz files whose .tr.txt to check")
+    parser.add_argument("--silent", help="read the font widths from this SILENT instead of messages/font_info.json")
+    parser.add_argument("--max-width", type=int,
+                        help="line width limit in pixels (default: the widest original line)")
+    parser.add_argument("--reflow", action="store_true",
+                        help="rewrite the .tr.txt files with the line breaks chosen to fit")
+    args = parser.parse_args(argv)
+
+    silent = DiscImage(args.silent).view if args.silent else None
+    metrics = load_metrics(silent)
+    if metrics is None:
+        sys.exit("no font widths: pass --silent or run extract_font_width first")
+
+    max_width = args.max_width or max_line_width(metrics, original_messages(args.overlays))
+    if args.reflow:
+        for ov in args.overlays:
+            reflow_file(metrics, ov + ".tr.txt", max_width)
+
+    overflows = check_overlays(metrics, args.overlays, max_width)
+    report_overflows(overflows)
+    print(f"{len(overflows)} lines wider than {max_width}px")
+    sys.exit(1 if overflows else 0)
+
+if __name__ == "__main__":
+    main()
@@ -6,66 +6,10 @@ import json
 import re
 from collections import namedtuple
 from common import *
+from freespace import pack_with_spill, overlay_free_list
 
 _offset = 0x800C9578
-OverlayInfos = [
-    OverlayInfo(0x092af,  422,  "map0_s00"),
-    OverlayInfo(0x092e4,  401,  "map0_s01"),
-    OverlayInfo(0x09317,  160,  "map0_s02"),
-    OverlayInfo(0x0932b,  381,  "map1_s00"),
-    OverlayInfo(0x0935b,  349,  "map1_s01"),
-    OverlayInfo(0x09387,  454,  "map1_s02"),
-    OverlayInfo(0x093c0,  463,  "map1_s03"),
-    #OverlayInfo(0x093fa,   75,  "map1_s04"),
-    OverlayInfo(0x09404,  242,  "map1_s05"),
-    OverlayInfo(0x09423,  284,  "map1_s06"),
-    OverlayInfo(0x09447,  708,  "map2_s00"),
-    OverlayInfo(0x094a0,  131,  "map2_s01"),
-    OverlayInfo(0x094b1,  631,  "map2_s02"),
-    #OverlayInfo(0x09500,   74,  "map2_s03"),
-    OverlayInfo(0x0950a,   95,  "map2_s04"),
-    OverlayInfo(0x09516,  201,  "map3_s00"),
-    OverlayInfo(0x09530,  243,  "map3_s01"),
-    OverlayInfo(0x0954f,  156,  "map3_s02"),
-    OverlayInfo(0x09563,  240,  "map3_s03"),
-    OverlayInfo(0x09581,  217,  "map3_s04"),
-    OverlayInfo(0x0959d,  320,  "map3_s05"),
-    OverlayInfo(0x095c5,  203,  "map3_s06"),
-    #OverlayInfo(0x095df,   64,  "map4_s00"),
-    OverlayInfo(0x095e7,  236,  "map4_s01"),
-    OverlayInfo(0x09605,  639,  "map4_s02"),
-    OverlayInfo(0x09655,  373,  "map4_s03"),
-    OverlayInfo(0x09684,  218,  "map4_s04"),
-    OverlayInfo(0x096a0,  293,  "map4_s05"),
-    #OverlayInfo(0x096c5,   64,  "map4_s06"),
-    OverlayInfo(0x096cd,  335,  "map5_s00"),
-    OverlayInfo(0x096f7,  682,  "map5_s01"),
-    OverlayInfo(0x0974d,  277,  "map5_s02"),
-    OverlayInfo(0x09770,  220,  "map5_s03"),
-    OverlayInfo(0x0978c,  684,  "map6_s00"),
-    OverlayInfo(0x097e2,  193,  "map6_s01"),
-    OverlayInfo(0x097fb,  185,  "map6_s02"),
-    OverlayInfo(0x09813,  363,  "map6_s03"),
-    OverlayInfo(0x09841,  586,  "map6_s04"),
-    #OverlayInfo(0x0988b,   65,  "map6_s05"),
-    OverlayInfo(0x09894,  175,  "map7_s00"),
-    OverlayInfo(0x098aa,  415,  "map7_s01"),
-    OverlayInfo(0x098de,  559,  "map7_s02"),
-    OverlayInfo(0x09924,  698,  "map7_s03"),
-]
-
-def nice_encode(line):
-    pattern = re.compile(r'(~[CLS]\d|~[MDHETN])')
-    jpattern= re.compile(r'(~J\d\(\d+\.\d+\))')
-    line = line.replace(' ', '').replace('\n', '').replace('\t', '')
-    line = line.replace('_', ' ')
-    line = pattern.sub(r'{\1}', line)
-    return jpattern.sub(r'{\1}', line).strip()
-
-def game_encode(line):
-    line = line.replace(' ', '_').replace('{', ' ').replace('}', ' ')
-    line = encode_local_text(line)
-    return line.encode('ascii') + b'\x00'
+OverlayInfos = [OverlayInfo(*ovi[:3]) for ovi in MapOverlays if ovi.messages]
 
 def dump_map_messages(silent: memoryview, ovi: OverlayInfo):
     mapdata = extract_overlay(silent, ovi)
@@ -73,28 +17,13 @@ def dump_map_messages(silent: memoryview, ovi: OverlayInfo):
     ptroffset = read_uint32_le(mapdata, 0x34) - _offset
     endoffset = read_uint32_le(mapdata, 0x28) - _offset
 
-    i = 0
-    msgs = []
-    msgptr = ptroffset
+    table = read_string_table(mapdata, ptroffset, endoffset, base=_offset)
+    msgs = [decode_braced(msg) for msg in table.decode()]
+    i = len(table)
 
-    while True:
-        if msgptr == endoffset:
-            break
-
-        msg1 = read_uint32_le(mapdata, msgptr)
-        if msg1 == 0:
-            break
-
-        msg1 -= _offset
-        msg1_str = read_c_string(mapdata, msg1)
-        msgs.append(nice_encode(msg1_str))
-        msgptr += 4
-        i += 1
-
-    txt_last_byte = read_uint32_le(mapdata, ptroffset) - _offset
-    txt_last_byte += len(read_c_string(mapdata, txt_last_byte))
-    txtoffset = read_uint32_le(mapdata, ptroffset + ((i-1)*4)) - _offset
-    txtlen = txt_last_byte - txtoffset
+    # the pointer table is in reverse: the first pointer is the last string
+    txtoffset = table[-1].start
+    txtlen = table[0].end - txtoffset
 
     output = {
             "txt-offset": f"0x{txtoffset:X}",
@@ -104,14 +33,25 @@ def dump_map_messages(silent: memoryview, ovi: OverlayInfo):
     }
 
     output["messages"] = msgs
-    with open("messages/" + mi.filename + ".json", 'w') as f:
+    with open("messages/" + ovi.filename + ".json", 'w') as f:
         json.dump(output, f, indent=4)
 
-def dump_maps(silent: memoryview):
-    for ovi in OverlayInfos:
-        dump_map_messages(silent, ovi)
+def _dump_map_job(image: DiscImage, ovi: OverlayInfo):
+    dump_map_messages(image.view, ovi)
 
-def patch_map(silent: memoryview, ovi: OverlayInfo):
+def dump_maps(silent: memoryview, image_path=None, jobs=1, member=None):
+    if jobs == 1 or image_path is None:
+        for ovi in OverlayInfos:
+            dump_map_messages(silent, ovi)
+        return
+
+    for ovi, out, error, patches in run_overlays_parallel(image_path, _dump_map_job, OverlayInfos, (),
+                                                          jobs or None, member):
+        print(out, end='')
+        if error is not None:
+            raise error[0]
+
+def patch_map(silent: memoryview, ovi: OverlayInfo, spill=False):
     with open("messages/" + ovi.filename + ".json", 'r', encoding="utf-8") as f:
         data = json.load(f)
 
@@ -119,17 +59,44 @@ def patch_map(silent: memoryview, ovi: OverlayInfo):
     txt_offset = int(data['txt-offset'], 16)
     ptr_offset = int(data['ptr-offset'], 16)
     max_txt_size = int(data['txt-size'], 16)
-    max_txt_size += txt_offset
-    for line in data['messages']:
-        txt_pointer = _offset + txt_offset
-        line = game_encode(line)
-        patch_pointer(mapdata, txt_pointer, ptr_offset)
-        patch_blob(mapdata, line, txt_offset)
-        txt_offset += len(line)
-        ptr_offset += 4
-        if txt_offset > max_txt_size:
-            raise MemoryError("Not enough room for the new text")
-
-def patch_maps(silent: memoryview):
-    for ovi in OverlayInfos:
-        patch_map(silent, ovi)
+
+    with instrument.span("encode", overlay=ovi.filename):
+        lines = [encode_braced(line) for line in data['messages']]
+    # with spill, what doesn't fit the text block moves into the zeros at the
+    # end of the overlay (see freespace.py)
+    free = None
+    if spill:
+        free = overlay_free_list(mapdata, 0, len(mapdata), name=ovi.filename,
+                                 used=[(txt_offset, txt_offset + max_txt_size), (ptr_offset, ptr_offset + 4 * len(lines))])
+    with instrument.span("pack", overlay=ovi.filename):
+        txt_blob, offsets, moved, saved = pack_with_spill(lines, max_txt_size, free, ovi.filename)
+    print(f"{ovi.filename}: packed text is 0x{len(txt_blob):x} of 0x{max_txt_size:x} bytes, saved {saved} bytes")
+
+    with instrument.span("patch", overlay=ovi.filename), PatchJournal(mapdata, ovi.filename) as journal:
+        journal.write(txt_offset, txt_blob)
+        journal.pointers(ptr_offset, [_offset + (txt_offset + offset if offset is not None else moved[line])
+                                      for line, offset in zip(lines, offsets)])
+        for line, offset in moved.items():
+            print(f"{ovi.filename}: moved {len(line)} bytes to 0x{offset:x} (0x{_offset + offset:08x})")
+            journal.write(offset, line)
+    instrument.count("text block", patched=len(txt_blob) + 4 * len(offsets), slack=max_txt_size - len(txt_blob))
+
+def _patch_map_job(image: DiscImage, ovi: OverlayInfo, spill):
+    patch_map(image.view, ovi, spill)
+
+def patch_maps(silent: memoryview, image_path=None, jobs=1, member=None, spill=False):
+    # With jobs != 1 every overlay is patched in a worker that maps
+    # image_path itself (or its file `member` when it is a CD image); the
+    # patched ranges are merged back into silent.
+    if jobs == 1 or image_path is None:
+        for ovi in OverlayInfos:
+            patch_map(silent, ovi, spill)
+        return
+
+    written = {}
+    for ovi, out, error, patches in run_overlays_parallel(image_path, _patch_map_job, OverlayInfos, (spill,),
+                                                          jobs or None, member):
+        print(out, end='')
+        if error is not None:
+            raise error[0]
+        merge_patches(silent, ovi.filename, patches, written)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import struct
+import hashlib
+import argparse
+from common import *
+
+# Binary patches. A build changes a few hundred KB of an image hundreds of MB
+# large, so instead of the image the changed bytes can be written as a PPF3
+# or IPS patch for players to apply to their own copy of the game.
+#
+# The patched runs are the image's dirty ranges cut down to the bytes that
+# really differ from the input (a re-encrypted BODYPROG or a pointer that
+# didn't move is dirty but unchanged). Runs closer than a record header are
+# joined, repeating the unchanged bytes between them is cheaper than a header.
+_changed = re.compile(rb'[^\x00]+')
+
+class ImagePatch:
+    def __init__(self, image, gap=0):
+        if isinstance(image, SectorFile):
+            # the patch is for the disc, with the sectors' EDC/ECC included
+            image.flush()
+            image = image.image
+        self.image = image
+        self.size = image.size
+        self.changes = self.changed_runs(image.dirty_ranges(), gap)
+
+    def original(self, offset, size):
+        return os.pread(self.image.file.fileno(), size, offset)
+
+    def patched(self, offset, size):
+        return self.image.view[offset: offset + size].tobytes()
+
+    def changed_runs(self, ranges, gap):
+        runs = []
+        for start, end in ranges:
+            size = end - start
+            old = int.from_bytes(self.original(start, size), 'little')
+            new = int.from_bytes(self.image.view[start:end], 'little')
+            for m in _changed.finditer((old ^ new).to_bytes(size, 'little')):
+                run_start, run_end = start + m.start(), start + m.end()
+                if runs and run_start - runs[-1][1] <= gap:
+                    runs[-1][1] = run_end
+                else:
+                    runs.append([run_start, run_end])
+        return [(start, self.patched(start, end - start)) for start, end in runs]
+
+# IPS: "PATCH", records of a 24 bit big endian offset, a 16 bit size and the
+# data, then "EOF". A size of 0 is a run (16 bit count, one byte) and a record
+# can't start at 0x454f46, which reads as "EOF".
+IpsMaxOffset = 1 << 24
+_ips_eof = 0x454f46
+
+def _ips_records(patch, offset, data):
+    pos = 0
+    while pos < len(data):
+        start = offset + pos
+        chunk = data[pos: pos + 0xfffe]
+        pos += len(chunk)
+        if start == _ips_eof:
+            # start a byte earlier, repeating the byte before
+            start -= 1
+            chunk = patch.patched(start, 1) + chunk
+        yield start, chunk
+
+def write_ips(path, patch):
+    out = bytearray(b'PATCH')
+    for offset, data in patch.changes:
+        if offset + len(data) > IpsMaxOffset:
+            raise ValueError(f"IPS can't patch offset 0x{offset:x}, past 16 MiB; use a .ppf patch")
+        for start, chunk in _ips_records(patch, offset, data):
+            out += start.to_bytes(3, 'big') + len(chunk).to_bytes(2, 'big') + chunk
+    out += b'EOF'
+    with open(path, 'wb') as f:
+        f.write(out)
+
+def read_ips(data):
+    if data[:5] != b'PATCH':
+        raise ValueError("not an IPS patch")
+    records = []
+    pos = 5
+    while data[pos: pos + 3] != b'EOF':
+        offset = int.from_bytes(data[pos: pos + 3], 'big')
+        size = int.from_bytes(data[pos + 3: pos + 5], 'big')
+        pos += 5
+        if size:
+            records.append((offset, data[pos: pos + size]))
+            pos += size
+        else:
+            count = int.from_bytes(data[pos: pos + 2], 'big')
+            records.append((offset, data[pos + 2: pos + 3] * count))
+            pos += 3
+        if pos > len(data):
+            raise ValueError("IPS patch is truncated")
+    return records, None
+
+# PPF3: "PPF30", encoding 2, a 50 byte description, image type, block check
+# and undo flags, then (with block check) the 1024 bytes at 0x9320 of the
+# original image, which tools compare before applying. Records are a 64 bit
+# little endian offset, a size of up to 255 and the data.
+_ppf_header = struct.Struct('<5sB50sBBBB')
+_ppf_check_offset = 0x9320
+_ppf_check_size = 1024
+
+def write_ppf(path, patch, description="Silent Hill translation"):
+    block_check = patch.size >= _ppf_check_offset + _ppf_check_size
+    out = bytearray(_ppf_header.pack(b'PPF30', 2, description.encode('ascii', 'replace')[:50].ljust(50),
+                                     0, block_check, 0, 0))
+    if block_check:
+        out += patch.original(_ppf_check_offset, _ppf_check_size)
+    for offset, data in patch.changes:
+        for pos in range(0, len(data), 0xff):
+            chunk = data[pos: pos + 0xff]
+            out += struct.pack('<QB', offset + pos, len(chunk)) + chunk
+    with open(path, 'wb') as f:
+        f.write(out)
+
+def read_ppf(data):
+    magic, encoding, _, _, block_check, undo, _ = _ppf_header.unpack_from(data)
+    if magic != b'PPF30' or encoding != 2:
+        raise ValueError("not a PPF3 patch")
+    pos = _ppf_header.size
+    check = None
+    if block_check:
+        check = (_ppf_check_offset, data[pos: pos + _ppf_check_size])
+        pos += _ppf_check_size
+
+    end = len(data)
+    if data[-20:-4] == b'@END_FILE_ID.DIZ':
+        # an optional file_id.diz at the end, followed by its length
+        end -= len(b'@BEGIN_FILE_ID.DIZ') + struct.unpack_from('<I', data, end - 4)[0] + 20
+    records = []
+    while pos < end:
+        offset, size = struct.unpack_from('<QB', data, pos)
+        pos += 9
+        records.append((offset, data[pos: pos + size]))
+        pos += size * (2 if undo else 1)
+    return records, check
+
+PatchFormats = {
+    ".ips": (write_ips, read_ips),
+    ".ppf": (write_ppf, read_ppf),
+}
+
+def patch_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in PatchFormats:
+        raise ValueError(f"unknown patch format {ext or path}, use one of {', '.join(PatchFormats)}")
+    return PatchFormats[ext]
+
+def read_patch(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return patch_format(path)[1](data)
+
+def write_patch(image, path):
+    # Writes what the build changed in image as a patch, the format picked by
+    # the extension, and checks the file reads back to the same bytes
+    writer, _ = patch_format(path)
+    patch = ImagePatch(image, gap=9 if writer is write_ppf else 5)
+    writer(path, patch)
+
+    records, _ = read_patch(path)
+    for offset, data in records:
+        if data != patch.patched(offset, len(data)):
+            raise ValueError(f"{path}: record at 0x{offset:x} doesn't match the build")
+    size = sum(len(data) for _, data in patch.changes)
+    print(f"{path}: {len(records)} records with {size} bytes of data, the patch is {os.path.getsize(path)} bytes")
+    return patch
+
+def apply_patch(patch_path, image_path, out_path):
+    records, check = read_patch(patch_path)
+    with open(image_path, 'rb') as f:
+        if check is not None:
+            offset, expected = check
+            f.seek(offset)
+            if f.read(len(expected)) != expected:
+                raise ValueError(f"{image_path} is not the image {patch_path} was made for")
+
+    if os.path.abspath(out_path) != os.path.abspath(image_path):
+        clone_file(image_path, out_path)
+    with open(out_path, 'r+b') as f:
+        for offset, data in records:
+            os.pwrite(f.fileno(), data, offset)
+    return records
+
+def file_digest(path, chunk_size=16 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply a .ppf or .ips patch made by translate_silent.py")
+    parser.add_argument("patch")
+    parser.add_argument("image", help="the original image")
+    parser.add_argument("out", help="where to write the patched image")
+    parser.add_argument("--expect", metavar="IMAGE",
+                        help="check the result is byte for byte this image (e.g. a full build)")
+    args = parser.parse_args(argv)
+
+    records = apply_patch(args.patch, args.image, args.out)
+    print(f"{args.out}: applied {len(records)} records")
+    if args.expect:
+        got, expected = file_digest(args.out), file_digest(args.expect)
+        if got != expected:
+            sys.exit(f"{args.out} differs from {args.expect}: sha1 {got}, expected {expected}")
+        print(f"{args.out} matches {args.expect}, sha1 {got}")
+
+if __name__ == "__main__":
+    main()
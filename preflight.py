@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import glob
+import json
+import argparse
+from common import *
+from bodyprog import InventoryRanges
+
+# Checks that every translation fits its text block before anything is
+# patched, from the source files alone: the .asciz overlays (the room is the
+# original text block, text-len in info.*), the messages/*.json map dumps
+# (txt-size) and the inventory (0x175c bytes in BODYPROG). Every block is
+# encoded and packed the way the build does it, no image is loaded.
+Block = namedtuple("Block", ["name", "size", "room", "offenders", "grown", "error"])
+
+def _offenders(encoded, originals, count):
+    # The entries that grew the most, or the longest ones without originals
+    if originals is not None:
+        sizes = [(len(new) - len(old), i) for i, (new, old) in enumerate(zip(encoded, originals))]
+    else:
+        sizes = [(len(new), i) for i, new in enumerate(encoded)]
+    return sorted(sizes, reverse=True)[:count]
+
+def check_block(name, encoded, room, originals=None, count=3):
+    txt_blob, _, _ = pack_strings(encoded)
+    return Block(name, len(txt_blob), room, _offenders(encoded, originals, count), originals is not None, None)
+
+def check_overlay(filename, count=3):
+    asciz = load_asciz(filename)
+    lines = read_translated_lines(filename + ".tr.txt")
+    if len(lines) < len(asciz):
+        raise IndexError(f"{filename}.tr.txt has fewer lines than {filename}")
+    encoded = encode_overlay(lines[:len(asciz)])
+    originals = [s.encode('latin-1') + b'\x00' for s in asciz.strings]
+    return check_block(filename, encoded, len(asciz.text_blob()), originals, count)
+
+def check_map_json(path, count=3):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    encoded = [encode_braced(line) for line in data['messages']]
+    return check_block(path, encoded, int(data['txt-size'], 16), None, count)
+
+def check_inventory_json(path="messages/inventory.json", count=3):
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    encoded = []
+    for item in data.values():
+        encoded += [encode_inventory(item['name']), encode_inventory(item['desc'])]
+    return check_block(path, encoded, InventoryRanges[0][1], None, count)
+
+def preflight(overlays=Overlays, count=3):
+    checks = [(check_overlay, ov) for ov in overlays]
+    checks += [(check_map_json, path) for path in sorted(glob.glob("messages/map*.json"))]
+    if os.path.exists("messages/inventory.json"):
+        checks.append((check_inventory_json, "messages/inventory.json"))
+
+    blocks = []
+    for check, name in checks:
+        try:
+            blocks.append(check(name, count=count))
+        except Exception as e:
+            blocks.append(Block(name, 0, 0, [], False, str(e)))
+    return blocks
+
+def print_report(blocks, verbose=False):
+    for b in blocks:
+        if b.error:
+            print(f"{b.name:<32} error: {b.error}")
+            continue
+        slack = b.room - b.size
+        if verbose or slack < 0:
+            status = "doesn't fit" if slack < 0 else "free"
+            print(f"{b.name:<32} 0x{b.size:04x} of 0x{b.room:04x} bytes, {slack:6d} {status}")
+            what = "grew by" if b.grown else "is"
+            for size, i in b.offenders:
+                print(f"    entry {i + 1} {what} {size} bytes")
+
+    size = sum(b.size for b in blocks)
+    room = sum(b.room for b in blocks if not b.error)
+    failed = [b for b in blocks if b.error or b.size > b.room]
+    print(f"{len(blocks)} blocks, 0x{size:x} of 0x{room:x} bytes used, {len(failed)} don't fit or failed")
+    return not failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the translations fit their text blocks, without the game image")
+    parser.add_argument("overlays", nargs="*", default=Overlays, help="overlays to check (default: all)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="list every block, not only the ones that overflow")
+    parser.add_argument("--offenders", type=int, default=3, metavar="N",
+                        help="entries to list for a block that doesn't fit")
+    args = parser.parse_args(argv)
+
+    ok = print_report(preflight(args.overlays, args.offenders), args.verbose)
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import glob
+import argparse
+from collections import Counter, defaultdict
+from common import *
+from catalog import Catalog, CatalogPath
+
+# Translation memory over every .asciz and its .tr.txt. A source string is
+# keyed by its plain text with the spacing around control codes and runs of
+# whitespace evened out and the case folded, so "It's locked.~E" and
+# "It's locked. ~E" are the same string; the keys are a dict, so an exact
+# lookup is one hash. For fuzzy lookups every key is also filed under its
+# character trigrams and a query only scores the keys that share one with it
+# (Dice coefficient). The entries come from the catalog (catalog.py), which
+# only reads an .asciz and its .tr.txt again when they changed, so a file can
+# be loaded again on its own cheaply, which is what the watch loop does when a
+# .tr.txt is saved.
+#
+# An entry still equal to its source is untranslated: it can be filled with
+# the translation the same source has elsewhere. Translated entries of the
+# same source that differ are reported as divergent.
+Unit = namedtuple("Unit", ["file", "entry", "source", "target"])
+
+_code_space = re.compile(r'\s*(~[CSL]\d|~J\d\([\d.]*\)|~[DHEMT])\s*')
+_space = re.compile(r'\s+')
+
+def normalize(text):
+    return _space.sub(' ', _code_space.sub(r' \1 ', text)).strip()
+
+def source_key(text):
+    return normalize(text).casefold()
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[i: i + 3] for i in range(len(padded) - 2)}
+
+def tr_files():
+    # The .asciz files that have a translation next to them
+    return sorted(path[:-len(".tr.txt")] for path in glob.glob("*.asciz.tr.txt"))
+
+class TranslationMemory:
+    def __init__(self, catalog=None):
+        self.catalog = catalog
+        self.units = {}
+        self.sources = defaultdict(list)
+        self.grams = defaultdict(set)
+        self._gram_counts = {}
+
+    def __len__(self):
+        return len(self.sources)
+
+    def add(self, filename, strings, entries):
+        self.remove(filename)
+        units = []
+        for i, (string, entry) in enumerate(zip(strings, entries)):
+            source = decode_plain(string).strip()
+            key = source_key(source)
+            target = None if normalize(entry) == normalize(source) else entry
+            unit = Unit(filename, i, source, target)
+            units.append(unit)
+            if key not in self.sources:
+                grams = trigrams(key)
+                self._gram_counts[key] = len(grams)
+                for gram in grams:
+                    self.grams[gram].add(key)
+            self.sources[key].append(unit)
+        self.units[filename] = units
+
+    def remove(self, filename):
+        # Keys left without units stay in the trigram index and are skipped
+        for unit in self.units.pop(filename, []):
+            key = source_key(unit.source)
+            units = self.sources[key]
+            units.remove(unit)
+            if not units:
+                del self.sources[key]
+
+    def load(self, filename):
+        # The entries past the end of the .asciz or of the .tr.txt are left out
+        self.catalog.sync([(filename, "asciz")])
+        entries = [e for e in self.catalog.entries(filename) if e.source is not None and e.translation is not None]
+        self.add(filename, [e.source for e in entries], [e.translation.strip() for e in entries])
+
+    def translations(self, text):
+        # Counter of the translations of a source string
+        units = self.sources.get(source_key(text), [])
+        return Counter(normalize(u.target) for u in units if u.target is not None)
+
+    def lookup(self, text):
+        # The most common translation, with the line breaks of its first use
+        translations = self.translations(text)
+        if not translations:
+            return None
+        best = translations.most_common(1)[0][0]
+        return next(u.target for u in self.sources[source_key(text)]
+                    if u.target is not None and normalize(u.target) == best)
+
+    def fuzzy(self, text, threshold=0.6, limit=5):
+        # [(score, key)] of the most similar source strings
+        grams = trigrams(source_key(text))
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+        matches = []
+        for key, count in shared.items():
+            if key not in self.sources:
+                continue
+            score = 2 * count / (len(grams) + self._gram_counts[key])
+            if score >= threshold:
+                matches.append((score, key))
+        matches.sort(reverse=True)
+        return matches[:limit]
+
+    def divergent(self, files=None):
+        # [(source, {translation: [units]})] of the sources translated in more
+        # than one way, only those with a unit in files when given
+        found = []
+        for key, units in self.sources.items():
+            if len(units) < 2 or (files is not None and not any(u.file in files for u in units)):
+                continue
+            targets = defaultdict(list)
+            for u in units:
+                if u.target is not None:
+                    targets[normalize(u.target)].append(u)
+            if len(targets) > 1:
+                found.append((units[0].source, dict(targets)))
+        return found
+
+    def fillable(self):
+        # {file: {entry: translation}} of the untranslated entries whose
+        # source is translated somewhere else
+        fills = defaultdict(dict)
+        for units in self.sources.values():
+            target = None
+            for u in units:
+                if u.target is None:
+                    if target is None:
+                        target = self.lookup(u.source) or ''
+                    if target:
+                        fills[u.file][u.entry] = target
+        return dict(fills)
+
+def load_memory(files=None, path=CatalogPath):
+    tm = TranslationMemory(Catalog(path))
+    for filename in tr_files() if files is None else files:
+        try:
+            tm.load(filename)
+        except OSError as e:
+            print(f"error with {filename}, {e}")
+    return tm
+
+def fill_file(filename, fills, tr_path=None):
+    # Only the filled entries are rewritten, the rest of the file stays as is
+    tr_path = tr_path or filename + ".tr.txt"
+    with open(tr_path, "r", encoding="utf-8") as f:
+        parts = f.read().split('\n-------')
+    for i, target in fills.items():
+        part = parts[i]
+        lead = part[:len(part) - len(part.lstrip())]
+        tail = part[len(part.rstrip()):]
+        parts[i] = lead + target + tail
+    with open(tr_path, 'w', encoding='utf-8') as f:
+        f.write('\n-------'.join(parts))
+
+def report_divergent(divergent, verbose=False):
+    for source, targets in divergent:
+        print(f"{source!r} is translated {len(targets)} ways")
+        for target, units in targets.items():
+            where = ', '.join(f"{u.file}:{u.entry + 1}" for u in units[:3 if not verbose else None])
+            more = f" and {len(units) - 3} more" if len(units) > 3 and not verbose else ""
+            print(f"    {target!r} in {where}{more}")
+
+def check_memory(tm, files=None):
+    # The consistency check of the build and, for the files saved, the watch loop
+    report_divergent(tm.divergent(files))
+    if files is not None:
+        return
+    fills = sum(len(entries) for entries in tm.fillable().values())
+    if fills:
+        print(f"{fills} untranslated entries repeat a translated string, tm.py --fill fills them in")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the translations for consistency across overlays")
+    parser.add_argument("files", nargs="*", help=".asciz files to check (default: every one with a .tr.txt)")
+    parser.add_argument("--fill", action="store_true",
+                        help="fill untranslated entries with the translation of the same string elsewhere")
+    parser.add_argument("--suggest", type=float, nargs="?", const=0.6, metavar="SCORE",
+                        help="list similar translated strings for the untranslated entries (default score 0.6)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="list every place of a divergent translation")
+    args = parser.parse_args(argv)
+
+    tm = load_memory()
+    files = set(args.files) if args.files else None
+
+    if args.fill:
+        for filename, fills in tm.fillable().items():
+            if files is None or filename in files:
+                fill_file(filename, fills)
+                print(f"{filename}.tr.txt: filled {len(fills)} entries")
+                tm.load(filename)
+
+    if args.suggest is not None:
+        for filename, units in tm.units.items():
+            if files is not None and filename not in files:
+                continue
+            for u in units:
+                if u.target is not None:
+                    continue
+                matches = [(score, tm.lookup(key)) for score, key in tm.fuzzy(u.source, args.suggest)]
+                matches = [(score, target) for score, target in matches if target is not None]
+                if matches:
+                    print(f"{filename}:{u.entry + 1} {u.source!r}")
+                    for score, target in matches:
+                        print(f"    {score:.2f} {target!r}")
+
+    divergent = tm.divergent(files)
+    report_divergent(divergent, args.verbose)
+    print(f"{len(tm)} distinct strings, {len(divergent)} translated more than one way")
+    sys.exit(1 if divergent else 0)
+
+if __name__ == "__main__":
+    main()
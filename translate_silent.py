@@ -2,28 +2,21 @@
 
 import sys
 import struct
+import os
+import argparse
 import traceback
+import hashlib
 import json
 import re
-
-def read_c_string(data, offset):
-    end = data.find(b'\x00', offset)
-    return data[offset:end].decode('ascii')
-
-def print_hex(blob):
-    hex_string = ' '.join(f'{byte:02X}' for byte in blob)
-    print(hex_string)
-
-def read_translated_lines(infile):
-    with open(infile, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    return [entry.strip() for entry in content.split('\n-------') ]
-
-def fix_encoding(txt):
-    txt = txt.replace('ł', ';').replace('ó', '*').replace('ę', '>').replace('ą', '^')
-    txt = txt.replace('ż', '=').replace('ć', '<').replace('ń', '+').replace('ś', '/').replace('ź', 'Q')
-    return txt.replace(' ', '@@@').replace('_', ' ').replace('@@@', '_').replace('\n', ' ~N ')
+import time
+from common import *
+from buildcache import *
+from watcher import *
+from layout import *
+from patchfile import *
+from textures import *
+from tm import load_memory, check_memory
+from freespace import pack_with_spill, text_free_list, overlay_bounds
 
 def find_blob_in_bin(blob, data, name):
     r = data.find(blob)
@@ -32,87 +25,121 @@ def find_blob_in_bin(blob, data, name):
 
     return r
 
-def read_asciz(text_file):
-    asciz_entries = {}
-    with open(text_file, encoding='utf-8') as f:
-        for line in f:
-            if not '.asciz' in line:
-                continue
-            try:
-                comment, rest = line.split('*/')
-                addr = int(comment.split()[-1], 16)
-                q1 = rest.index('"') + 1
-                q2 = rest.rindex('"')
-                text = rest[q1:q2]
-                asciz_entries[addr] = {'asciz': text, 'new-ptr': 0}
-            except:
-                continue
-    return asciz_entries
+def first_location(offsets, name):
+    if not offsets:
+        raise Exception(f"can't find a blob {name}")
 
+    return offsets[0]
+
+def build_new_ptr_blob(asciz, new_addresses):
+    moved = dict(zip(asciz.addresses, new_addresses))
+    return le_words(array('I', [moved[ptr] for ptr in asciz.pointers]))
+
+def build_new_txt_blob(asciz, filename, tr_path=None, free=None, txt_offset=0):
+    # Strings that don't fit the old text block move into free (a FreeList of
+    # image offsets, txt_offset being the block's); returns them as
+    # {string: offset} to be written there
+    tr_path = tr_path or filename + ".tr.txt"
+    with instrument.span("encode"):
+        translated_lines = read_translated_lines(tr_path)
+        encoded = encode_overlay(translated_lines[:len(asciz)])
+    if len(encoded) < len(asciz):
+        raise IndexError(f"{tr_path} has fewer lines than {filename}")
+
+    with instrument.span("pack") as span:
+        txt_blob, offsets, moved, saved = pack_with_spill(encoded, len(asciz.text_blob()), free, filename)
+        span.set(saved=saved)
+    new_addresses = array('I', [asciz.base + (offset if offset is not None else moved[s] - txt_offset)
+                                for s, offset in zip(encoded, offsets)])
+
+    print(f"{filename}: packed text is 0x{len(txt_blob):x} bytes, saved {saved} bytes")
+    return txt_blob, new_addresses, moved
+
+def overlay_blobs(filename):
+    asciz = load_asciz(filename)
+    return asciz.pointer_blob(), asciz.text_blob()
+
+def scan_for_blobs(data, blobs, chunk_size=1 << 20):
+    # One pass over the image: every chunk is searched for all blobs while it
+    # is still in cache. Chunks overlap by the longest blob so matches across a
+    # chunk boundary are found, and are only counted in the chunk they start in.
+    instrument.count("bytes scanned", bytes=len(data))
+    found = {blob: [] for blob in blobs}
+    overlap = max((len(blob) for blob in blobs), default=1) - 1
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start: start + chunk_size + overlap]
+        for blob in blobs:
+            r = chunk.find(blob)
+            while r != -1 and r < chunk_size:
+                found[blob].append(start + r)
+                r = chunk.find(blob, r + 1)
+
+    return found
+
+def own_locations(game, ov, ptr_offsets, txt_offsets):
+    # A blob can also be found inside another overlay: the text block of
+    # map1_s04, map2_s03, map4_s00, ... is a part of map0_s00's. In SILENT only
+    # what is inside the overlay's own sectors counts. Elsewhere (a whole disc
+    # searched as flat bytes, an image not laid out like SILENT) the text
+    # blocks are tried nearest to the pointer table first.
+    ovi = map_overlay(ov)
+    if ovi is not None and not is_cd_image(game):
+        start, end = overlay_range(ovi)
+        ptr_inside = [r for r in ptr_offsets if start <= r < end]
+        txt_inside = [r for r in txt_offsets if start <= r < end]
+        if ptr_inside and txt_inside:
+            return {"ptr": ptr_inside, "txt": txt_inside}
+    if ptr_offsets:
+        txt_offsets = sorted(txt_offsets, key=lambda r: abs(r - ptr_offsets[0]))
+    return {"ptr": list(ptr_offsets), "txt": txt_offsets}
+
+def locate_overlays(game, game_path, overlays, sidecar="located.json", member=None):
+    blobs = {}
+    for ov in overlays:
+        try:
+            blobs[ov] = overlay_blobs(ov)
+        except Exception as e:
+            print(f"error with {ov}, {e}")
 
-def read_pointers(text_file):
-    pointers = []
-    with open(text_file, encoding='utf-8') as f:
-        for line in f:
-            if not '.word' in line:
-                continue
-            value = int(line.split('.word')[1].strip(), 16)
-            pointers.append(value)
-    return pointers
-
-def build_old_text_blob(asciz_entries, base):
-    blob = b''
-    ptr = base
-    for k, v in asciz_entries.items():
-        decoded = bytes(v['asciz'], 'utf-8').decode('unicode_escape')
-        encoded = decoded.encode('utf-8') + b'\x00'
-
-        blob += encoded
-        ptr += len(encoded)
-
-        align = (ptr + 3 ) & ~3
-        blob += (b'\x00' * (align - ptr))
-        ptr = align
-
-    return blob
-
-def build_new_ptr_blob(asciz_entries, pointers):
-    blob = b''
-    for ptr in pointers:
-        blob += struct.pack('<I', asciz_entries[ptr]['new-ptr'])
-    return blob
-
-def build_new_txt_blob(asciz_entries, txt_base, filename):
-    txt_blob = b''
-    translated_index = 0
-    translated_lines = read_translated_lines(filename + ".tr.txt")
-    for k, v in asciz_entries.items():
-        new_text = fix_encoding(translated_lines[translated_index])
-        translated_index += 1
-
-        offset = len(txt_blob)
-        txt_blob += new_text.encode('ascii') + b'\x00'
-        v['new-ptr'] = txt_base + offset
-
-    return txt_blob
-
-def patch_blob(game, blob, offset):
-    bloblen = len(blob)
-    game[offset:offset + bloblen] = blob
-
-def patch_overlay(game, filename):
-    print(f"Try overlay {filename}")
-    asciz_entries = read_asciz(filename)
-    txt_base = next(iter(asciz_entries))
-
-    pointers = read_pointers(filename)
-    ptr_blob = b''.join(struct.pack('<I', ptr) for ptr in pointers)
-    ptr_data_offset = find_blob_in_bin(ptr_blob, game, "ptr")
-
-    txt_blob = build_old_text_blob(asciz_entries, txt_base)
-    txt_data_offset = find_blob_in_bin(txt_blob, game, "txt")
-
-    with open("info."+filename, 'w') as f:
+    st = os.stat(game_path)
+    digest = hashlib.sha1()
+    for ov, (ptr_blob, txt_blob) in blobs.items():
+        digest.update(ov.encode() + ptr_blob + txt_blob)
+    key = {
+        "image-size": st.st_size,
+        "image-mtime": st.st_mtime_ns,
+        "member": member,
+        "blobs-sha1": digest.hexdigest(),
+        "within": "overlay",
+    }
+
+    if os.path.exists(sidecar):
+        with open(sidecar, 'r') as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["overlays"]
+
+    with instrument.span("scan"):
+        found = scan_for_blobs(game, {blob for pair in blobs.values() for blob in pair})
+    located = {}
+    for ov, (ptr_blob, txt_blob) in blobs.items():
+        located[ov] = own_locations(game, ov, found[ptr_blob], found[txt_blob])
+        for name, offsets in located[ov].items():
+            if not offsets:
+                print(f"{ov}: can't find a blob {name}")
+            elif len(offsets) > 1:
+                where = ', '.join(f"0x{r:x}" for r in offsets)
+                print(f"{ov}: blob {name} is ambiguous ({where}), using the first one")
+
+    with open(sidecar, 'w') as f:
+        json.dump({"key": key, "overlays": located}, f, indent=4)
+
+    return located
+
+def dump_overlay_text(game, filename, asciz, txt_blob, txt_data_offset, ptr_data_offset):
+    txt_base = asciz.base
+    pointers = asciz.pointers
+    with instrument.span("dump"), open("info."+filename, 'w') as f:
         data = {
             "text-ptr": f"0x{txt_data_offset:x}",
             "text-len": f"0x{len(txt_blob):x}",
@@ -120,71 +147,315 @@ def patch_overlay(game, filename):
             "pointers": f"0x{ptr_data_offset:x}",
             "lines-no": f"0x{len(pointers):x}"
         }
-        strings = []
-        for p in pointers:
-            pointer = (p - txt_base) + txt_data_offset 
-            strings.append(read_c_string(game, pointer))
-            
-
+        strings = read_strings(game, [(p - txt_base) + txt_data_offset for p in pointers]).decode()
         data["messages"]= strings
         json.dump(data, f, indent=4)
 
-    with open("translate."+filename, 'w') as f:
-        for p in pointers:
-            pointer = (p - txt_base) + txt_data_offset 
-            msg = read_c_string(game, pointer)
-            msg = msg.replace('_', '@@@').replace(' ', '').replace('@@@', ' ')
-            msg = msg.replace(')\t', ')\\t').replace('\t', '').replace(')\\t', ')\t')
-            msg = msg.replace('\n', '').replace('~N', '\n')
-            # Make the code stand out a bit more
-            msg =  re.sub(r'\s*~C\d\s*', lambda m: f' {m.group(0).strip()} ', msg)
-            msg =  re.sub(r'\s*~S\d\s*', lambda m: f' {m.group(0).strip()} ', msg)
-            msg =  re.sub(r'\s*~L\d\s*', lambda m: f' {m.group(0).strip()} ', msg)
-            #msg = re.sub(r'(~[A-Z]\d)(\d+)', r'\1 \2', msg)
-            msg =  re.sub(r'\s*~D\s*', lambda m: f' {m.group(0).strip()} ', msg)
-            msg =  re.sub(r'\s*~H\s*', lambda m: f' {m.group(0).strip()} ', msg)
-            msg =  re.sub(r'\s*~E\s*', lambda m: f' {m.group(0).strip()} ', msg)
-            msg =  re.sub(r'\s*~M\s*', lambda m: f' {m.group(0).strip()} ', msg)
-            msg =  re.sub(r'^ ~', '~', msg)
+    with instrument.span("dump"), open("translate."+filename, 'w') as f:
+        for msg in decode_overlay(strings):
             f.write(f"{msg}\n------\n")
 
-    return
-
-    new_txt_blob = build_new_txt_blob(asciz_entries, txt_base, filename)
-    new_ptr_blob = build_new_ptr_blob(asciz_entries, pointers)
-    patch_blob(game, new_txt_blob, txt_data_offset)
-    patch_blob(game, new_ptr_blob, ptr_data_offset)
-    for k, v in asciz_entries.items():
-        ns = read_c_string(new_txt_blob, (v['new-ptr'] - txt_base))
-        print(f"org: {k:x}  new: {v['new-ptr']:x}  val: {v['asciz']}  new: {ns}")
-
-def main():
-    game_in = sys.argv[1]
-    game_out = sys.argv[2]
-    game = None
-    with open(game_in, 'rb') as f:
-        game = bytearray(f.read())
-    overlays = [ "map0_s00.asciz", "map0_s01.asciz", "map0_s02.asciz", "map1_s00.asciz",
-                 "map1_s01.asciz", "map1_s02.asciz", "map1_s03.asciz", "map1_s04.asciz",
-                 "map1_s05.asciz", "map1_s06.asciz", "map2_s00.asciz", "map2_s01.asciz",
-                 "map2_s02.asciz", "map2_s03.asciz", "map2_s04.asciz", "map3_s00.asciz",
-                 "map3_s01.asciz", "map3_s02.asciz", "map3_s03.asciz", "map3_s04.asciz",
-                 "map3_s05.asciz", "map3_s06.asciz", "map4_s00.asciz", "map4_s01.asciz",
-                 "map4_s02.asciz", "map4_s04.asciz", "map4_s05.asciz", "map4_s06.asciz",
-                 "map5_s00.asciz", "map5_s01.asciz", "map5_s02.asciz", "map5_s03.asciz",
-                 "map6_s00.asciz", "map6_s01.asciz", "map6_s02.asciz", "map6_s03.asciz",
-                 "map6_s04.asciz", "map6_s05.asciz", "map7_s00.asciz", "map7_s01.asciz",
-                 "map7_s02.asciz", "map7_s03.asciz" ]
-
+def patch_overlay(game, filename, located=None, asciz=None, tr_path=None, dump=True, spill=False):
+    # asciz: the parsed source if the caller has it already, tr_path: the
+    # translation to use instead of <filename>.tr.txt, dump: write the
+    # info. and translate. dumps of the original text, spill: move what
+    # doesn't fit the text block into the overlay's free space.
+    # Returns the ranges written outside the text block and pointer table.
+    with instrument.span("overlay", overlay=filename) as overlay:
+        print(f"Try overlay {filename}")
+        with instrument.span("load"):
+            if asciz is None:
+                asciz = load_asciz(filename)
+            ptr_blob = asciz.pointer_blob()
+            txt_blob = asciz.text_blob()
+
+        with instrument.span("locate"):
+            if located is None:
+                ptr_data_offset = find_blob_in_bin(ptr_blob, game, "ptr")
+                txt_data_offset = find_blob_in_bin(txt_blob, game, "txt")
+            else:
+                ptr_data_offset = first_location(located["ptr"], "ptr")
+                txt_data_offset = first_location(located["txt"], "txt")
+
+        if dump:
+            dump_overlay_text(game, filename, asciz, txt_blob, txt_data_offset, ptr_data_offset)
+
+        free = None
+        if spill:
+            free = overlay_free_space(game, (ptr_blob, txt_blob),
+                                      {"ptr": [ptr_data_offset], "txt": [txt_data_offset]}, filename)
+        new_txt_blob, new_addresses, moved = build_new_txt_blob(asciz, filename, tr_path, free, txt_data_offset)
+        with instrument.span("patch"), PatchJournal(game, filename) as journal:
+            new_ptr_blob = build_new_ptr_blob(asciz, new_addresses)
+            journal.write(txt_data_offset, new_txt_blob)
+            journal.write(ptr_data_offset, new_ptr_blob)
+            for s, offset in moved.items():
+                print(f"{filename}: moved {len(s)} bytes to 0x{offset:x} (0x{asciz.base + offset - txt_data_offset:08x})")
+                journal.write(offset, s)
+        patched = len(new_txt_blob) + len(new_ptr_blob)
+        slack = len(txt_blob) - len(new_txt_blob)
+        overlay.set(patched=patched, slack=slack)
+        instrument.count("text block", patched=patched, slack=slack)
+        return [(offset, offset + len(s)) for s, offset in moved.items()]
+
+def overlay_cache_key(game, filename, located, member=None, spill=False):
+    # Everything a patched overlay depends on: the tool itself and the modules
+    # that parse, encode and pack the text, the character table, the source
+    # and translation files, whether it may spill and the image bytes it
+    # replaces.
+    if located is None:
+        return None
+
+    ptr_blob, txt_blob = overlay_blobs(filename)
+    ptr_offset = first_location(located["ptr"], "ptr")
+    txt_offset = first_location(located["txt"], "txt")
+    free = overlay_free_space(game, (ptr_blob, txt_blob), located) if spill else None
+    return hash_parts(
+        hash_files(__file__, *(sys.modules[name].__file__
+                               for name in ("common", "codec", "asciz", "cstrings", "freespace"))),
+        json.dumps(LocalCharacters),
+        hash_files(filename, filename + ".tr.txt"),
+        f"{member}:{ptr_offset:x}:{txt_offset:x}:{spill}:{free.regions if free else None}",
+        game[ptr_offset: ptr_offset + len(ptr_blob)],
+        game[txt_offset: txt_offset + len(txt_blob)],
+    )
+
+def _patch_overlay_job(image, ov, located, spill):
+    patch_overlay(image.data, ov, located.get(ov), spill=spill)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Patch translated text into the game image")
+    parser.add_argument("game_in")
+    parser.add_argument("game_out", nargs="?",
+                        help="the patched image; can be left out when only --patch files are wanted")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="patch overlays in this many processes (0 = one per core)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="rebuild every overlay instead of replaying .buildcache")
+    parser.add_argument("--file", metavar="NAME",
+                        help="patch this file of the CD image (e.g. SILENT) sector by sector, "
+                             "regenerating EDC/ECC, instead of the image as flat bytes")
+    parser.add_argument("--spill", action="store_true",
+                        help="move text that doesn't fit its block into the zeros at the end of "
+                             "the overlay instead of failing; nothing checks the game doesn't use "
+                             "them, so test the overlays it warns about")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write a Chrome trace (chrome://tracing, ui.perfetto.dev) of the build")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also record the tracemalloc peak of every traced stage (slow)")
+    parser.add_argument("--watch", action="store_true",
+                        help="after the build, keep the image loaded and repatch game_out in place "
+                             "whenever an overlay's .asciz or .tr.txt is saved")
+    parser.add_argument("--poll", action="store_true",
+                        help="watch by polling file times instead of inotify")
+    parser.add_argument("--textures", metavar="DIR",
+                        help="inject the PNGs edited in DIR since textures.dump_textures/dump_font "
+                             "wrote them (game_in must be SILENT, or use --file SILENT)")
+    parser.add_argument("--patch", metavar="FILE", action="append", default=[],
+                        help="also write the changes as a patch against game_in, .ppf (PPF3) "
+                             "or .ips by the extension; can be given more than once")
+    args = parser.parse_args(argv)
+    if args.game_out is None and (args.watch or not args.patch):
+        parser.error("game_out is needed unless only --patch files are written")
+    for path in args.patch:
+        try:
+            patch_format(path)
+        except ValueError as e:
+            parser.error(str(e))
+
+    if args.trace:
+        instrument.enable(args.trace, args.trace_memory)
+    try:
+        image, located, overlays = build(args)
+        if args.watch:
+            watch(args, image, located, overlays)
+    finally:
+        instrument.finish()
+
+def check_layout(image, overlays):
+    # Warns about translated lines wider than the game's own widest line. The
+    # font widths come from BODYPROG, or from messages/font_info.json when the
+    # input is a whole disc searched as flat bytes.
+    silent = image.data if not is_cd_image(image.data) else None
+    try:
+        metrics = load_metrics(silent)
+        if metrics is not None:
+            report_overflows(check_overlays(metrics, overlays))
+    except Exception as e:
+        print(f"error checking line widths, {e}")
+
+def build(args):
+    game_in = args.game_in
+    game_out = args.game_out
+    with instrument.span("load"):
+        image = open_image(game_in, args.file)
+    game = image.data
+    overlays = Overlays
+
+    with instrument.span("locate"):
+        located = locate_overlays(game, game_in, overlays, member=args.file)
+    if args.spill:
+        print("warning: --spill moves the text that doesn't fit into the zeros at the end of its "
+              "overlay, which may be the overlay's own data")
+    cache = None if args.no_cache else BuildCache()
+    keys = {}
+    todo = []
+    written = {}
     for ov in overlays:
+        if cache is not None:
+            try:
+                keys[ov] = overlay_cache_key(game, ov, located.get(ov), args.file, args.spill)
+            except Exception:
+                keys[ov] = None
+            patches = cache.get(keys[ov]) if keys[ov] else None
+            if patches is not None:
+                print(f"Cached overlay {ov}")
+                with instrument.span("cached overlay", overlay=ov):
+                    try:
+                        merge_patches(game, ov, patches, written)
+                    except PatchOverlapError as e:
+                        print(f"error with {ov}, {e}")
+                continue
+        todo.append(ov)
+
+    if args.jobs == 1:
+        for ov in todo:
+            try:
+                mark = len(image.dirty)
+                patch_overlay(game, ov, located.get(ov), spill=args.spill)
+                patches = image.patches_since(mark)
+                check_patched(image, ov, patches, written)
+                if keys.get(ov):
+                    cache.put(keys[ov], ov, patches)
+            except Exception as e:
+                print(f"error with {ov}, {e}")
+                traceback.print_exc()
+                continue
+    else:
+        results = run_overlays_parallel(game_in, _patch_overlay_job, todo,
+                                        (located, args.spill), args.jobs or None, args.file)
+        for ov, out, error, patches in results:
+            print(out, end='')
+            if error is not None:
+                e, tb = error
+                print(f"error with {ov}, {e}")
+                sys.stderr.write(tb)
+                continue
+            try:
+                merge_patches(game, ov, patches, written)
+            except PatchOverlapError as e:
+                print(f"error with {ov}, {e}")
+                traceback.print_exc()
+                continue
+            if keys.get(ov):
+                cache.put(keys[ov], ov, patches)
+
+    if args.textures:
+        with instrument.span("textures"):
+            if is_cd_image(image.data):
+                print(f"error with {args.textures}, textures need SILENT, not the whole disc (use --file SILENT)")
+            else:
+                patch_textures(image.view, args.textures)
+
+    with instrument.span("layout"):
+        check_layout(image, overlays)
+
+    with instrument.span("consistency"):
         try:
-            patch_overlay(game, ov)
+            check_memory(load_memory())
         except Exception as e:
-            print(f"error with {ov}, {e}")
-            traceback.print_exc()
+            print(f"error checking translation consistency, {e}")
+
+    with instrument.span("write") as span:
+        if cache is not None:
+            cache.save()
+        span.set(patched=sum(end - start for start, end in image.dirty_ranges()))
+        if game_out is not None:
+            image.save(game_out)
+        for path in args.patch:
+            try:
+                write_patch(image, path)
+            except ValueError as e:
+                print(f"error with {path}, {e}")
+    return image, located, overlays
+
+def overlay_slots(blobs, located):
+    # The ranges patch_overlay writes besides the strings it moves out: the
+    # whole old text block and the pointer table
+    ptr_blob, txt_blob = blobs
+    ptr_offset = first_location(located["ptr"], "ptr")
+    txt_offset = first_location(located["txt"], "txt")
+    return [(txt_offset, txt_offset + len(txt_blob)), (ptr_offset, ptr_offset + len(ptr_blob))]
+
+def overlay_free_space(game, blobs, located, name=None):
+    # The FreeList patch_overlay moves strings into, None when there is none
+    txt_offset = first_location(located["txt"], "txt")
+    return text_free_list(game, txt_offset, len(blobs[1]), overlay_slots(blobs, located), name)
+
+def spilled_slots(image, blobs, located):
+    # What the build wrote into the map overlay holding the text block, so
+    # the strings it moved into the overlay's free space are put back too
+    txt_offset = first_location(located["txt"], "txt")
+    bounds = None if is_cd_image(image.data) else overlay_bounds(txt_offset, len(blobs[1]))
+    if bounds is None:
+        return []
+    start, end = bounds
+    return [(max(s, start), min(e, end)) for s, e in image.dirty_ranges() if s < end and e > start]
+
+def repatch_overlay(image, ov, located, blobs, slots, spill=False):
+    # Puts the overlay's slots back to the input bytes and patches it again,
+    # locating it anew if its .asciz changed. Returns every range touched.
+    old = slots.pop(ov, [])
+    for start, end in old:
+        image.restore(start, end)
+
+    new_blobs = overlay_blobs(ov)
+    if blobs.get(ov) != new_blobs or ov not in located:
+        found = scan_for_blobs(image.data, set(new_blobs))
+        located[ov] = own_locations(image.data, ov, found[new_blobs[0]], found[new_blobs[1]])
+        blobs[ov] = new_blobs
+
+    moved = patch_overlay(image.data, ov, located[ov], spill=spill)
+    slots[ov] = overlay_slots(new_blobs, located[ov]) + moved
+    return old + slots[ov]
+
+def watch(args, image, located, overlays):
+    blobs = {}
+    slots = {}
+    for ov in overlays:
+        try:
+            blobs[ov] = overlay_blobs(ov)
+            slots[ov] = overlay_slots(blobs[ov], located[ov]) + spilled_slots(image, blobs[ov], located[ov])
+        except Exception:
             continue
 
-    with open(game_out, 'wb') as f:
-        f.write(game)
-
-main()
+    sources = {}
+    for ov in overlays:
+        sources[os.path.abspath(ov)] = ov
+        sources[os.path.abspath(ov + ".tr.txt")] = ov
+
+    tm = load_memory()
+    print(f"Watching {len(overlays)} overlays for changes, Ctrl-C to stop")
+    try:
+        for changed in watch_files(sources, args.poll):
+            for ov in sorted({sources[path] for path in changed}):
+                start = time.perf_counter()
+                touched = slots.get(ov, [])
+                with instrument.span("repatch", overlay=ov):
+                    try:
+                        touched = repatch_overlay(image, ov, located, blobs, slots, args.spill)
+                    except Exception as e:
+                        print(f"error with {ov}, {e}")
+                        traceback.print_exc()
+                    image.update(args.game_out, touched)
+                print(f"{ov}: repatched {args.game_out} in {(time.perf_counter() - start) * 1000:.1f} ms")
+                try:
+                    tm.load(ov)
+                    check_memory(tm, {ov})
+                except Exception as e:
+                    print(f"error checking translation consistency, {e}")
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
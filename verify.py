@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import re
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from common import *
+from translate_silent import locate_overlays, first_location, overlay_blobs, overlay_slots, overlay_free_space
+
+# Reads a build back and checks it against its input and the translations:
+# every overlay's pointer table has to point into its old text block, or with
+# --spill the free space the build moves strings into, at the strings of its
+# .tr.txt, encoded, and every byte outside those and the pointer tables has
+# to be the input's. The overlays and 8 MiB pieces of the
+# rest are checked by a process pool; each worker maps both images once.
+Mismatch = namedtuple("Mismatch", ["where", "offset", "message"])
+_chunk_size = 8 << 20
+_changed = re.compile(b'[^\x00]')
+
+_images = None
+
+def _init_worker(game_in, game_out, member):
+    global _images
+    _images = (open_image(game_in, member), open_image(game_out, member))
+
+def first_difference(a, b):
+    size = len(a)
+    diff = (int.from_bytes(a, 'little') ^ int.from_bytes(b, 'little')).to_bytes(size, 'little')
+    m = _changed.search(diff)
+    return m.start() if m else None
+
+def verify_overlay(ov, located, spill=False):
+    original, out = _images
+    game = out.data
+    asciz = load_asciz(ov)
+    ptr_offset = first_location(located["ptr"], "ptr")
+    txt_offset = first_location(located["txt"], "txt")
+    room = len(asciz.text_blob())
+    free = overlay_free_space(original.data, (asciz.pointer_blob(), asciz.text_blob()), located) if spill else None
+    inside = [(txt_offset, txt_offset + room)] + (free.regions if free else [])
+
+    expected = encode_overlay(read_translated_lines(ov + ".tr.txt")[:len(asciz)])
+    entry = {address: i for i, address in enumerate(asciz.addresses)}
+    pointers = read_pointers(game, ptr_offset, count=len(asciz.pointers))
+    if len(pointers) != len(asciz.pointers):
+        return [Mismatch(ov, ptr_offset + 4 * len(pointers), "pointer table ends early")]
+
+    mismatches = []
+    offsets = []
+    for j, p in enumerate(pointers):
+        offset = txt_offset + p - asciz.base
+        if not any(start <= offset < end for start, end in inside):
+            mismatches.append(Mismatch(ov, ptr_offset + 4 * j, f"pointer 0x{p:x} is outside the text block"))
+        offsets.append(offset)
+    if mismatches:
+        return mismatches
+
+    strings = read_strings(game, offsets)
+    for j, s in enumerate(strings):
+        i = entry[asciz.pointers[j]]
+        if i >= len(expected):
+            mismatches.append(Mismatch(ov, s.start, f"entry {i + 1} is missing from {ov}.tr.txt"))
+        elif bytes(s) + b'\x00' != expected[i]:
+            found = decode_plain(s.decode('latin-1'))
+            wanted = decode_plain(expected[i][:-1].decode('latin-1'))
+            mismatches.append(Mismatch(ov, s.start, f"entry {i + 1} reads {found!r}, not {wanted!r}"))
+    return mismatches
+
+def verify_untouched(start, end, slots):
+    # Compares [start, end) of both images, skipping the slots that overlap it
+    original, out = _images
+    gaps = []
+    pos = start
+    for slot_start, slot_end in slots:
+        if slot_start > pos:
+            gaps.append((pos, slot_start))
+        pos = max(pos, slot_end)
+    if pos < end:
+        gaps.append((pos, end))
+
+    for gap_start, gap_end in gaps:
+        a = original.data[gap_start: gap_end]
+        b = out.data[gap_start: gap_end]
+        if a != b:
+            return [Mismatch("untouched", gap_start + first_difference(a, b), "differs from the input")]
+    return []
+
+def verify(game_in, game_out, overlays=Overlays, member=None, jobs=None, first=False, spill=False):
+    original = open_image(game_in, member)
+    out = open_image(game_out, member)
+    if len(original.data) != len(out.data):
+        return [Mismatch("image", 0, f"is 0x{len(out.data):x} bytes, not 0x{len(original.data):x}")]
+    located = locate_overlays(original.data, game_in, overlays, member=member)
+
+    # Overlays the build couldn't find are skipped like the build skips them
+    mismatches = []
+    checked = []
+    slots = []
+    for ov in overlays:
+        try:
+            # what the build may write: the text block, the pointer table
+            # and with spill the free space strings are moved into
+            blobs = overlay_blobs(ov)
+            free = overlay_free_space(original.data, blobs, located[ov]) if spill else None
+            slots += overlay_slots(blobs, located[ov]) + (free.regions if free else [])
+            checked.append(ov)
+        except Exception as e:
+            print(f"{ov}: skipped, {e}")
+    slots.sort()
+
+    size = len(original.data)
+    with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(game_in, game_out, member)) as pool:
+        futures = [pool.submit(verify_overlay, ov, located[ov], spill) for ov in checked]
+        for start in range(0, size, _chunk_size):
+            end = min(size, start + _chunk_size)
+            inside = [(s, e) for s, e in slots if s < end and e > start]
+            futures.append(pool.submit(verify_untouched, start, end, inside))
+        for future in as_completed(futures):
+            mismatches += future.result()
+            if first and mismatches:
+                for other in futures:
+                    other.cancel()
+                break
+    return sorted(mismatches, key=lambda m: m.offset)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check a patched image against its input and the translations")
+    parser.add_argument("game_in")
+    parser.add_argument("game_out")
+    parser.add_argument("overlays", nargs="*", default=Overlays, help="overlays to check (default: all)")
+    parser.add_argument("--file", metavar="NAME",
+                        help="check this file of the CD images (e.g. SILENT), as the build patched it")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="worker processes (0 = one per core)")
+    parser.add_argument("--first", action="store_true", help="stop at the first mismatch")
+    parser.add_argument("--spill", action="store_true",
+                        help="accept strings moved into the overlays' free space, for a build made with --spill")
+    args = parser.parse_args(argv)
+
+    mismatches = verify(args.game_in, args.game_out, args.overlays, args.file, args.jobs or None, args.first, args.spill)
+    for m in mismatches:
+        print(f"{m.where}: 0x{m.offset:x} {m.message}")
+    print(f"{len(mismatches)} mismatches" if mismatches else f"{args.game_out} matches {args.game_in} and the translations")
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# Yields batches of watched files that were saved. Editors either rewrite a
+# file in place or write a new one and rename it over the old, so the
+# directories are watched rather than the files themselves.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+_event = struct.Struct('iIII')
+
+class InotifyWatcher:
+    def __init__(self, paths):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.dirs = {}
+        self.paths = {os.path.abspath(path) for path in paths}
+        for directory in {os.path.dirname(path) for path in self.paths}:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), f"can't watch {directory}")
+            self.dirs[wd] = directory
+
+    def read(self, timeout):
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        data = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = _event.unpack_from(data, pos)
+            pos += _event.size
+            name = os.fsdecode(data[pos: pos + size].rstrip(b'\x00'))
+            pos += size
+            path = os.path.join(self.dirs.get(wd, ''), name)
+            if path in self.paths:
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    def __init__(self, paths, interval=0.25):
+        self.interval = interval
+        self.mtimes = {os.path.abspath(path): self.mtime(path) for path in paths}
+
+    @staticmethod
+    def mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def read(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            changed = set()
+            for path, old in self.mtimes.items():
+                new = self.mtime(path)
+                if new != old and new is not None:
+                    self.mtimes[path] = new
+                    changed.add(path)
+            if changed or time.monotonic() >= deadline:
+                return changed
+            time.sleep(min(self.interval, max(0, deadline - time.monotonic())))
+
+    def close(self):
+        pass
+
+def open_watcher(paths, poll=False):
+    if not poll:
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError):
+            # no inotify (not Linux, or out of watches)
+            pass
+    return PollingWatcher(paths)
+
+def watch_files(paths, poll=False, settle=0.03):
+    # A save often comes as several events (truncate, write, rename), so after
+    # the first one the batch is held open for `settle` seconds.
+    watcher = open_watcher(paths, poll)
+    try:
+        while True:
+            changed = watcher.read(3600)
+            if not changed:
+                continue
+            while True:
+                more = watcher.read(settle)
+                if not more:
+                    break
+                changed |= more
+            yield changed
+    finally:
+        watcher.close()